@@ -62,6 +62,15 @@ class ConfigBase(object):
         config = cls()
         parser.parse_args(namespace=config)  # sets parsed arguments as attributes of namespace
 
+        # str -> list arguments, parsed once in the main process
+        if isinstance(config.block_config, str):
+            setattr(config, 'block_config', tuple(int(a) for a in config.block_config.split(',')))
+
+        # all CPUs available to this process (split across GPUs in `main_worker`)
+        if config.num_workers < 0:
+            cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+            setattr(config, 'num_workers', len(cpus))
+
         return config
 
     @classmethod
@@ -144,16 +153,32 @@ class ConfigBase(object):
         parser.add_argument('--image_size', type=int, default=72)
         parser.add_argument('--small_kernel', type=str2bool, default=True)
         parser.add_argument('--random_state', type=int, default=2022)
+        parser.add_argument('--storage_dtype', type=str, default='float16',
+                            choices=('float32', 'float16', 'int16', 'uint8'),
+                            help='Data type of the memory-mapped volumes; integer types require integer-valued volumes.')
+        parser.add_argument('--cache_images', type=str2bool, default=False,
+                            help='Keep loaded volumes (float32) in one shared-memory cache for all splits, filled by the DataLoader workers.')
+        parser.add_argument('--prefetch_workers', type=int, default=0,
+                            help='Threads warming the page cache with the data files before training (0 to disable); '
+                                 'reads whole files, so it does not pay off with --crop_first.')
 
         # augmentation
         # TODO: remove --crop, --blur
         parser.add_argument('--intensity', type=str, default='scale', choices=('scale', 'normalize', 'minmax'))
         parser.add_argument('--crop_size', type=int, default=64)
+        parser.add_argument('--crop_first', type=str2bool, default=False,
+                            help='Crop the center sub-volume at load time, before resizing to `crop_size`.')
+        parser.add_argument('--resize_cache', type=str2bool, default=False,
+                            help='Resize volumes once and cache them on disk, instead of resizing every sample.')
         parser.add_argument('--rotate', type=str2bool, default=True)
         parser.add_argument('--flip', type=str2bool, default=True)
         parser.add_argument('--affine', type=str2bool, default=False)
         parser.add_argument('--blur_std', type=float, default=0.0)
         parser.add_argument('--prob', type=float, default=0.5)
+        parser.add_argument('--transfer_dtype', type=str, default='float32', choices=('float32', 'float16'),
+                            help='Data type of the volumes sent from the DataLoader to the GPU.')
+        parser.add_argument('--gpu_augment', type=str2bool, default=False,
+                            help='Apply rotate, flip and noise augmentations to batches on the GPU.')
 
         return parser
 
@@ -179,6 +204,14 @@ class ConfigBase(object):
 
         # cnn
 
+        # compilation
+        parser.add_argument('--compile', type=str2bool, default=False, help='Compile networks with torch.compile.')
+        parser.add_argument('--compile_mode', type=str, default='default',
+                            choices=('default', 'max-autotune-no-cudagraphs'),
+                            help='torch.compile mode; max-autotune benchmarks kernels for the static input shapes.')
+        parser.add_argument('--channels_last', type=str2bool, default=False,
+                            help='Use the channels-last (NDHWC) memory format for networks and inputs.')
+
         return parser
 
     @staticmethod
@@ -187,7 +220,8 @@ class ConfigBase(object):
         parser = argparse.ArgumentParser("Model Training", add_help=False)
         parser.add_argument('--epochs', type=int, default=100, help='Number of training epochs.')
         parser.add_argument('--batch_size', type=int, default=16, help='Mini-batch size.')
-        parser.add_argument('--num_workers', type=int, default=4, help='Number of CPU threads.')
+        parser.add_argument('--num_workers', type=int, default=4, help='Number of CPU threads; -1 uses all available CPUs.')
+        parser.add_argument('--prefetch_factor', type=int, default=4, help='Batches loaded in advance by each worker.')
         parser.add_argument('--optimizer', type=str, default='adamw', choices=('sgd', 'adamw'), help='Optimization algorithm.')
         parser.add_argument('--learning_rate', type=float, default=0.0001, help='Base learning rate to start from.')
         parser.add_argument('--weight_decay', type=float, default=1e-4, help='Weight decay factor.')
@@ -195,6 +229,9 @@ class ConfigBase(object):
         parser.add_argument('--cosine_cycles', type=int, default=1, help='Number of hard cosine LR cycles with hard restarts.')
         parser.add_argument('--cosine_min_lr', type=float, default=0.0, help='LR lower bound when cosine scheduling is used.')
         parser.add_argument('--mixed_precision', type=str2bool, default=False, help='Use float16 precision.')
+        parser.add_argument('--amp_dtype', type=str, default='float16', choices=('float16', 'bfloat16', 'auto'),
+                            help='Data type of mixed precision; bfloat16 needs no gradient scaling (Ampere or newer), '
+                                 'auto uses bfloat16 where supported.')
         return parser
 
     @staticmethod
@@ -7,14 +7,27 @@ class SupMoCoConfig(ConfigBase):
     def __init__(self, args=None, **kwargs):
         super(SupMoCoConfig, self).__init__(args, **kwargs)
 
+    @classmethod
+    def parse_arguments(cls) -> argparse.Namespace:
+        """Create a configuration object from command line arguments, with list arguments parsed once."""
+        config = super(SupMoCoConfig, cls).parse_arguments()
+        setattr(config, 'knn_k', [int(a) for a in config.knn_k.split(',')])
+        setattr(config, 'alphas', [float(a) for a in config.alphas.split(',')])
+        setattr(config, 'alphas_min', [float(a) for a in config.alphas_min.split(',')])
+        setattr(config, 'alphas_decay_end', [int(a) for a in config.alphas_decay_end.split(',')])
+        return config
+
     @staticmethod
     def task_specific_parser() -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser('MoCO', add_help=False)
         parser.add_argument('--projector_dim', type=int, default=128, help='Dimension of projection head.')
         parser.add_argument('--temperature', type=float, default=0.2, help='Logit scaling factor.')
         parser.add_argument('--num_negatives', type=int, default=512, help='Number of negative examples to maintain.')
+        parser.add_argument('--queue_dtype', type=str, default='float16', choices=('float32', 'float16'),
+                            help='Data type of the memory queue.')
         parser.add_argument('--key_momentum', type=float, default=0.999, help='Momentum for updating key encoder.')
         parser.add_argument('--split_bn', action='store_true')
+        parser.add_argument('--ddp_bucket_mb', type=int, default=25, help='Size of DDP gradient buckets in MB.')
         parser.add_argument('--knn_k', type=str, default="1, 5, 15", help='')
         parser.add_argument('--alphas', type=str, default="1.0, 1.0", help='weights for losses')
         parser.add_argument('--alphas_min', type=str, default="1.0, 0.0",
@@ -1,26 +1,29 @@
 import os
 import pandas as pd
 import numpy as np
-import pickle
 
 import random
 import torch
 from torch.utils.data import Dataset
-from sklearn.model_selection import StratifiedGroupKFold
 from sklearn.utils import class_weight
 from sklearn.preprocessing import MinMaxScaler
 
+from datasets.splits import stratified_group_kfold
+from datasets.memmap import convert_to_memmap
+
 
 class AIBLProcessor(object):
     def __init__(self,
                  root: str = 'D:/data/AIBL',
                  data_info: str = 'data_info.csv',
                  time_window: int = 36,
+                 storage_dtype: str = 'float16',
                  random_state: int = 2021):
 
         # Processor for PiB scans
         self.root = root
         self.time_window = time_window
+        self.storage_dtype = storage_dtype
         self.random_state = random_state
 
         # PiB data (paired with MRI)
@@ -54,6 +57,9 @@ class AIBLProcessor(object):
         self.u_data_info = data_info.loc[data_info['Conv_36'].isin([-1])].reset_index(drop=True)
         self.data_info = data_info.loc[data_info['Conv_36'].isin([0, 1])].reset_index(drop=True)
 
+        # one-time conversion of pickled volumes to memory-mapped .npy files
+        self.convert_to_memmap(dtype=self.storage_dtype)
+
     def process(self, n_splits=10, n_cv=0, test_only=False):
 
         # def process
@@ -61,12 +67,8 @@ class AIBLProcessor(object):
         conv = self.data_info['Conv_36'].tolist()
         assert 0 <= n_cv < n_splits
 
-        cv = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=2021)
-
-        train_idx_list, test_idx_list = [], []
-        for train_idx, test_idx in cv.split(X=rid, y=conv, groups=rid):
-            train_idx_list.append(train_idx)
-            test_idx_list.append(test_idx)
+        train_idx_list, test_idx_list = stratified_group_kfold(rid=rid, y=conv, n_splits=n_splits, random_state=2021,
+                                                               cache_dir=os.path.join(self.root, 'splits'))
         train_idx, test_idx = train_idx_list[n_cv], test_idx_list[n_cv]
 
         train_info = self.data_info.iloc[train_idx].reset_index(drop=True)
@@ -88,6 +90,7 @@ class AIBLProcessor(object):
         self.class_weight = class_weight.compute_class_weight(class_weight='balanced',
                                                               classes=np.unique(train_data['y']),
                                                               y=train_data['y'])
+        self.class_weight_t = torch.from_numpy(self.class_weight.astype(np.float32))
         if test_only:
             test_data.update(train_data)
             train_data = None
@@ -97,11 +100,22 @@ class AIBLProcessor(object):
         return datasets
 
     def parse_info(self, data_info):
-        image_files = [os.path.join(self.root, f'template/PIB/{p}') if type(p) == str else p
-                       for p in data_info['image_file'].tolist()]
+        image_files = [self.str2image(p) if type(p) == str else p for p in data_info['image_file'].tolist()]
         y = data_info['Conv_36'].values
         return dict(image_files=image_files, y=y)
 
+    def convert_to_memmap(self, dtype='float16', overwrite: bool = False):
+        """
+        Convert pickled PiB volumes to `.npy` files which can be memory-mapped by `AIBLDataset.load_image`.
+        See `datasets.memmap.convert_to_memmap` for the supported dtypes.
+        """
+        names = pd.concat([self.data_info['image_file'], self.u_data_info['image_file']])
+        files = {os.path.join(self.root, f'template/PIB/{p}'): self.str2image(p) for p in names.dropna().unique()}
+        convert_to_memmap(files, dtype=dtype, overwrite=overwrite)
+
+    def str2image(self, p):
+        return os.path.join(self.root, 'template/PIB.mmap', os.path.splitext(p)[0] + '.npy')
+
 #
 class AIBLDataset(Dataset):
 
@@ -109,22 +123,35 @@ class AIBLDataset(Dataset):
                  dataset: dict,
                  transform,
                  **kwargs):
-        self.image_files = dataset['image_files']
+        # fixed-width string array (see `BrainBase`); missing files become empty strings instead of 'nan'
+        self.image_files = np.asarray([p if isinstance(p, str) else '' for p in dataset['image_files']],
+                                      dtype=np.str_)
         self.y = dataset['y']
         self.transform = transform
+        # optional cache of the loaded volumes in shared memory (see `BrainBase`)
+        self.cache = None
 
     def __getitem__(self, idx):
-        img = self.load_image(path=self.image_files[idx])
+        img = self.get_image(idx)
         if self.transform is not None:
             img = self.transform(img)
         y = self.y[idx]
         return dict(x=img, y=y, idx=idx)
 
+    def get_image(self, idx):
+        path = self.image_files[idx]
+        if self.cache is None:
+            return self.load_image(path=path)
+        return self.cache.get(path, lambda: self.load_image(path=path))
+
     @staticmethod
-    def load_image(path):
-        with open(path, 'rb') as fb:
-            image = pickle.load(fb)
-        return image
+    def load_image(path, dtype=np.float32):
+        # fixed .npy header + raw buffer; no unpickling of the array on every access
+        return np.ascontiguousarray(np.load(path, mmap_mode='r'), dtype=dtype)
+
+    @property
+    def paths(self):
+        return self.image_files
 
     def __len__(self):
         return len(self.y)
@@ -12,7 +12,7 @@ def make_randaugment(image_size: int = 72,
                      intensity: str = 'normalize',
                      k: int = 2):
 
-    base_transform = [ToTensor(), AddChannel(), Resize((image_size, image_size, image_size))]
+    base_transform = [torch.as_tensor, AddChannel(), Resize((image_size, image_size, image_size))]
 
     # scaling
     if intensity is None:
@@ -1,14 +1,17 @@
 import os
 import pandas as pd
 import numpy as np
-import pickle
 
 import random
 import torch
 from torch.utils.data import Dataset
-from sklearn.model_selection import StratifiedGroupKFold
 from sklearn.utils import class_weight
 from sklearn.preprocessing import MinMaxScaler
+from monai.transforms import Resize
+
+from datasets.splits import stratified_group_kfold
+from datasets.memmap import convert_to_memmap
+from utils.files import atomic_path, rank_zero_first
 
 
 class BrainProcessor(object):
@@ -19,6 +22,7 @@ class BrainProcessor(object):
                  mci_only: bool = False,
                  add_apoe: bool = False,
                  add_volume: bool = False,
+                 storage_dtype: str = 'float16',
                  random_state: int = 2022):
 
         self.root = root
@@ -29,6 +33,7 @@ class BrainProcessor(object):
         self.demo_columns = ['PTGENDER (1=male, 2=female)', 'Age', 'PTEDUCAT', 'MMSCORE']
         self.add_apoe = add_apoe
         self.add_volume = add_volume
+        self.storage_dtype = storage_dtype
 
         if self.add_apoe:
             self.demo_columns = self.demo_columns + ['APOE Status']
@@ -57,23 +62,28 @@ class BrainProcessor(object):
         else:
             self.data_info = self.data_info[~self.data_info.PET.isna()]
 
+        # keep only the columns used downstream (smaller frames to copy into workers)
+        columns = ['RID', 'Conv', 'MRI', 'PET', 'MC', 'Volume'] + self.demo_columns
+        self.data_info = self.data_info[list(dict.fromkeys(columns))]
+
         # unlabeled and labeled
         self.u_data_info = self.data_info[self.data_info['Conv'].isin([-1])].reset_index(drop=True)
         self.data_info = self.data_info[self.data_info['Conv'].isin([0, 1])].reset_index(drop=True)
 
+        # one-time conversion of pickled volumes to memory-mapped .npy files
+        self.convert_to_memmap(dtype=self.storage_dtype)
+
     def process(self, n_splits=10, n_cv=0):
 
         # prepare
         rid = self.data_info.RID.tolist()
         conv = self.data_info.Conv.tolist()
-        cv = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=self.random_state)
         assert 0 <= n_cv < n_splits
 
-        # train-test split
-        train_idx_list, test_idx_list = [], []
-        for train_idx, test_idx in cv.split(X=rid, y=conv, groups=rid):
-            train_idx_list.append(train_idx)
-            test_idx_list.append(test_idx)
+        # train-test split (cached on disk)
+        train_idx_list, test_idx_list = stratified_group_kfold(rid=rid, y=conv, n_splits=n_splits,
+                                                               random_state=self.random_state,
+                                                               cache_dir=os.path.join(self.root, 'splits'))
 
         train_idx, test_idx = train_idx_list[n_cv], test_idx_list[n_cv]
         train_info = self.data_info.iloc[train_idx].reset_index(drop=True)
@@ -101,6 +111,7 @@ class BrainProcessor(object):
         self.class_weight = class_weight.compute_class_weight(class_weight='balanced',
                                                               classes=np.unique(train_data['y']),
                                                               y=train_data['y'])
+        self.class_weight_t = torch.from_numpy(self.class_weight.astype(np.float32))
 
         datasets = {'train': train_data,
                     'test': test_data,
@@ -155,19 +166,64 @@ class BrainProcessor(object):
         self.data_info[self.demo_columns] = data_demo[self.demo_columns]
 
     def parse_data(self, data_info):
-        mri_files = [self.str2mri(p) if type(p) == str else p for p in data_info.MRI]
-        pet_files = [self.str2pet(p) if type(p) == str else p for p in data_info.PET]
+        # vectorized version of `str2mri` / `str2pet`; missing scans stay NaN
+        mri_files = (os.path.join(self.root, 'template/FS7.mmap', '') + data_info.MRI + '.npy').tolist()
+        pet_files = (os.path.join(self.root, 'template/PUP_FBP.mmap', '') + data_info.PET + '.npy').tolist()
         demo = data_info[self.demo_columns].values
         mc = data_info['MC'].values
         volume = data_info['Volume'].values
-        y = data_info.Conv.values
+        y = np.ascontiguousarray(data_info.Conv.values, dtype=np.int64)
         return dict(mri=mri_files, pet=pet_files, demo=demo, mc=mc, volume=volume, y=y)
 
+    def convert_to_memmap(self, dtype='float16', overwrite: bool = False):
+        """
+        Convert pickled volumes to `.npy` files which can be memory-mapped by `BrainBase.load_image`.
+        See `datasets.memmap.convert_to_memmap` for the supported dtypes.
+        """
+        if self.data_type == 'mri':
+            names, src, dst = pd.concat([self.data_info.MRI, self.u_data_info.MRI]), 'template/FS7', self.str2mri
+        else:
+            names, src, dst = pd.concat([self.data_info.PET, self.u_data_info.PET]), 'template/PUP_FBP', self.str2pet
+
+        files = {os.path.join(self.root, src, f'{i}.pkl'): dst(i) for i in names.dropna().unique()}
+        convert_to_memmap(files, dtype=dtype, overwrite=overwrite)
+
+    def resize_to_memmap(self, dataset: dict, image_size: int, crop_ratio: float = None, overwrite: bool = False):
+        """
+        Resize the volumes of a parsed split (see `parse_data`) to `image_size` once, after the optional
+        center crop, and store them as `.npy` files under a sub-directory keyed by the output geometry.
+        Returns a copy of `dataset` pointing to the resized volumes, so `Resize` can be dropped from the transforms.
+        In distributed runs only rank 0 resizes, while the other ranks wait for it.
+        Resizing commutes with global intensity scaling (e.g., minmax), but per-volume statistics of
+        'scale' and 'normalize' are then computed on the resized volumes.
+        """
+        tag = str(image_size) if crop_ratio is None else f'{image_size}_crop{crop_ratio:.4f}'
+        dtype = self.storage_dtype if np.issubdtype(np.dtype(self.storage_dtype), np.floating) else 'float16'
+        resize = Resize((image_size, image_size, image_size))
+
+        files = {path: os.path.join(os.path.dirname(path), tag, os.path.basename(path))
+                 for path in dataset[self.data_type] if isinstance(path, str)}
+        with rank_zero_first() as is_main:
+            if is_main:
+                for src, dst in files.items():
+                    if overwrite or not os.path.exists(dst):
+                        image = BrainBase.load_image(path=src, crop_ratio=crop_ratio)
+                        image = np.asarray(resize(image[None]))[0]
+                        with atomic_path(dst) as tmp:
+                            np.save(tmp, np.ascontiguousarray(image, dtype=dtype))
+
+        # missing scans (not a path) are passed through
+        paths = [files[path] if isinstance(path, str) else path for path in dataset[self.data_type]]
+
+        dataset = dict(dataset)
+        dataset[self.data_type] = paths
+        return dataset
+
     def str2mri(self, i):
-        return os.path.join(self.root, 'template/FS7', f'{i}.pkl')
+        return os.path.join(self.root, 'template/FS7.mmap', f'{i}.npy')
 
     def str2pet(self, i):
-        return os.path.join(self.root, 'template/PUP_FBP', f'{i}.pkl')
+        return os.path.join(self.root, 'template/PUP_FBP.mmap', f'{i}.npy')
 
 
 class BrainBase(Dataset):
@@ -175,6 +231,8 @@ class BrainBase(Dataset):
     def __init__(self,
                  dataset: dict,
                  data_type: str,
+                 crop_ratio: float = None,
+                 min_max: tuple = None,
                  **kwargs):
         self.mri = dataset['mri']
         self.pet = dataset['pet']
@@ -186,22 +244,61 @@ class BrainBase(Dataset):
         assert data_type in ['mri', 'pet']
         self.data_type = data_type
 
+        # fixed-width string array: one flat buffer instead of per-element python objects, whose
+        # reference counts would trigger copy-on-write in every forked DataLoader worker;
+        # missing scans (NaN) become empty strings instead of the string 'nan'
         if self.data_type == 'mri':
-            self.paths = self.mri
+            self.paths = np.asarray([p if isinstance(p, str) else '' for p in self.mri], dtype=np.str_)
         elif self.data_type == 'pet':
-            self.paths = self.pet
+            self.paths = np.asarray([p if isinstance(p, str) else '' for p in self.pet], dtype=np.str_)
         else:
             raise ValueError
 
+        # crop before the transforms, so that only the center sub-volume is read from disk
+        self.crop_ratio = crop_ratio
+
+        # fixed (min, max) intensity statistics, applied while casting the loaded volume
+        self.min_max = min_max
+
+        # optional cache of the loaded volumes in shared memory, filled by the DataLoader workers;
+        # attached with `datasets.memmap.share_volume_cache`, so that it can be shared with the other splits
+        self.cache = None
+
     def __len__(self):
         return len(self.y)
 
+    def get_image(self, idx):
+        path = self.paths[idx]
+        if self.cache is None:
+            return self.load_image(path=path, crop_ratio=self.crop_ratio, min_max=self.min_max)
+        return self.cache.get(path, lambda: self.load_image(path=path, crop_ratio=self.crop_ratio,
+                                                            min_max=self.min_max))
+
     @staticmethod
-    def load_image(path):
-        with open(path, 'rb') as fb:
-            image = pickle.load(fb)
+    def load_image(path, crop_ratio=None, dtype=np.float32, min_max=None):
+        # memory-mapped; only the pages that are read are faulted in, and they are shared through the OS page cache
+        image = np.load(path, mmap_mode='r')
+        if crop_ratio is not None:
+            image = image[BrainBase.center_crop_bbox(image.shape, crop_ratio)]
+        # volumes may be stored in half precision; the transforms run in `dtype`
+        if min_max is None:
+            return np.ascontiguousarray(image, dtype=dtype)
+        # cast and min-max scaling in a single sweep instead of a copy followed by `MinMax`
+        xmin, xmax = min_max
+        image = np.subtract(image, xmin, dtype=dtype)
+        image *= 1. / (xmax - xmin)
         return image
 
+    @staticmethod
+    def center_crop_bbox(shape, crop_ratio):
+        """Center bounding box covering `crop_ratio` of each axis, placed as in `CenterSpatialCrop`."""
+        bbox = []
+        for s in shape:
+            size = max(int(round(s * crop_ratio)), 1)
+            start = max(s // 2 - size // 2, 0)
+            bbox.append(slice(start, start + size))
+        return tuple(bbox)
+
 
 class Brain(BrainBase):
 
@@ -210,7 +307,7 @@ class Brain(BrainBase):
         self.transform = transform
 
     def __getitem__(self, idx):
-        img = self.load_image(path=self.paths[idx])
+        img = self.get_image(idx)
         if self.transform is not None:
             img = self.transform(img)
         demo = self.demo[idx]
@@ -228,7 +325,7 @@ class BrainMoCo(BrainBase):
         self.key_transform = key_transform
 
     def __getitem__(self, idx):
-        img = self.load_image(path=self.paths[idx])
+        img = self.get_image(idx)
         x1 = self.query_transform(img)
         x2 = self.key_transform(img)
         demo = self.demo[idx]
@@ -0,0 +1,83 @@
+import os
+import pickle
+import numpy as np
+import torch
+
+from utils.files import atomic_path, rank_zero_first
+
+
+def convert_to_memmap(files: dict, dtype: str = 'float16', overwrite: bool = False, max_error: float = 1e-3):
+    """
+    Convert pickled volumes to `.npy` files which can be memory-mapped with `np.load(..., mmap_mode='r')`.
+    Arguments:
+        files: dict mapping the path of each pickled volume to the path of its `.npy` file.
+        dtype: str, float16 by default to halve the bytes read per sample. Integer dtypes
+            (e.g., 'uint8' for conformed FreeSurfer intensities) are only allowed for integer-valued volumes
+            within the range of the dtype, so that storage remains lossless.
+        overwrite: bool, convert files that already exist with the requested dtype as well.
+        max_error: float, largest rounding error allowed for float dtypes, relative to the largest absolute
+            value of the volume. Volumes which overflow the dtype (e.g., raw scanner intensities in float16)
+            or exceed this error raise a ValueError; convert them with 'float32' instead.
+    Each file is written to a temporary file and then moved into place, so that existing files are always complete.
+    In distributed runs only rank 0 converts, while the other ranks wait for it.
+    """
+    with rank_zero_first() as is_main:
+        if not is_main:
+            return
+        for src, dst in files.items():
+            if os.path.exists(dst) and not overwrite and np.load(dst, mmap_mode='r').dtype == dtype:
+                continue
+            with open(src, 'rb') as fb:
+                image = np.asarray(pickle.load(fb))
+            if np.issubdtype(np.dtype(dtype), np.integer):
+                info = np.iinfo(dtype)
+                if not (np.array_equal(image, np.rint(image)) and info.min <= image.min() and image.max() <= info.max):
+                    raise ValueError(f"{src} is not integer-valued within the range of {dtype}.")
+            converted = np.ascontiguousarray(image, dtype=dtype)
+            if np.issubdtype(np.dtype(dtype), np.floating):
+                if not np.isfinite(converted).all():
+                    raise ValueError(f"{src} has values which are not finite in {dtype}.")
+                error = np.abs(converted.astype(np.float64) - image).max()
+                if error > max_error * np.abs(image).max():
+                    raise ValueError(f"{src} loses precision in {dtype} (max. error {error:.4g}).")
+            with atomic_path(dst) as tmp:
+                np.save(tmp, converted)
+
+
+class SharedVolumeCache(object):
+    """
+    Loaded volumes, kept in shared memory (`torch.Tensor.share_memory_`) and filled lazily.
+    Unlike a `multiprocessing.Manager().dict()`, whose every access pickles the volume over a socket,
+    all DataLoader workers read & write the same buffer directly. Volumes are keyed by path, so that one cache
+    can serve all datasets of a run (see `share_volume_cache`) and a volume used by several of them is stored once.
+    The buffer holds every distinct volume in float32, i.e., `len(set(paths)) * prod(shape) * 4` bytes of
+    shared memory, allocated up front.
+    """
+    def __init__(self, paths: list, shape: tuple):
+        # sorted fixed-width string array, searched with `np.searchsorted` (no per-element python objects)
+        self.paths = np.unique(np.asarray([p for p in paths if p], dtype=np.str_))
+        self.volumes = torch.empty((len(self.paths), *shape), dtype=torch.float32).share_memory_()
+        self.loaded = torch.zeros(len(self.paths), dtype=torch.bool).share_memory_()
+
+    def get(self, path: str, load_fn):
+        idx = int(np.searchsorted(self.paths, path))
+        if idx == len(self.paths) or self.paths[idx] != path:
+            raise KeyError(path)
+        if not self.loaded[idx]:
+            self.volumes[idx] = torch.from_numpy(load_fn())
+            self.loaded[idx] = True  # set after the copy, so that other workers never see a partial volume
+        # transforms may modify their input in-place; hand out a private copy of the shared volume
+        return self.volumes[idx].numpy().copy()
+
+
+def share_volume_cache(datasets: list):
+    """
+    Attach a single `SharedVolumeCache` over the paths of all `datasets`, which must load their volumes
+    in the same way (i.e., the same crop & intensity scaling), e.g., the train, eval & test sets of a run.
+    """
+    paths = [p for dataset in datasets for p in dataset.paths]
+    first = next(i for i, p in enumerate(datasets[0].paths) if p)
+    cache = SharedVolumeCache(paths=paths, shape=datasets[0].get_image(first).shape)
+    for dataset in datasets:
+        dataset.cache = cache
+    return cache
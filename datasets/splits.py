@@ -0,0 +1,39 @@
+import os
+import hashlib
+import numpy as np
+
+from sklearn.model_selection import StratifiedGroupKFold
+
+from utils.files import atomic_path
+
+
+def stratified_group_kfold(rid: list, y: list, n_splits: int, random_state: int, cache_dir: str = None):
+    """
+    Train/test indices of every fold of `StratifiedGroupKFold`, grouped by `rid`.
+    The split is deterministic given its inputs; if `cache_dir` is given, it is computed once and
+    stored as `{cache_dir}/{hash}.npz` keyed by (rid, y, n_splits, random_state).
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(repr((list(rid), list(y), n_splits, random_state)).encode())
+    path = None if cache_dir is None else os.path.join(cache_dir, f'{key.hexdigest()}.npz')
+
+    if path is not None and os.path.exists(path):
+        with np.load(path) as f:
+            return [f[f'train_{i}'] for i in range(n_splits)], [f[f'test_{i}'] for i in range(n_splits)]
+
+    cv = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    train_idx_list, test_idx_list = [], []
+    for train_idx, test_idx in cv.split(X=rid, y=y, groups=rid):
+        train_idx_list.append(train_idx)
+        test_idx_list.append(test_idx)
+
+    if path is not None:
+        try:
+            arrays = {f'train_{i}': idx for i, idx in enumerate(train_idx_list)}
+            arrays.update({f'test_{i}': idx for i, idx in enumerate(test_idx_list)})
+            with atomic_path(path) as tmp:
+                np.savez(tmp, **arrays)
+        except OSError:
+            pass  # read-only data directory; the split is simply recomputed next time
+
+    return train_idx_list, test_idx_list
@@ -1,18 +1,28 @@
+import os
+import json
 import time
+import pickle
+import hashlib
+import functools
 import numpy as np
+from typing import List, Optional
 
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from monai.transforms import (
-    Compose, AddChannel, RandRotate, RandRotate90, Resize, ScaleIntensity, ToTensor, RandFlip, RandZoom, RandAffine,
+    Compose, CastToType, AddChannel, RandRotate, RandRotate90, Resize, ScaleIntensity, ToTensor, RandFlip, RandZoom, RandAffine,
     RandSpatialCrop, NormalizeIntensity, RandGaussianNoise, Transform, CenterSpatialCrop,
     AddChannel
 )
-from torchvision.transforms import ConvertImageDtype, Normalize
+from torchvision.transforms import Normalize
 from monai.utils.enums import TransformBackends
 from monai.config import DtypeLike
 from monai.utils import convert_data_type
 
+from utils.files import atomic_path
+
 
 class MinMax(Transform):
 
@@ -32,6 +42,114 @@ class MinMax(Transform):
         return ret
 
 
+@functools.lru_cache()
+def load_min_max(root: str, data_type: str):
+    """
+    Returns the (min, max) intensity statistics of `data_type` from `labels/minmax.json`.
+    The JSON file is written once from `labels/minmax.pkl` if it does not exist yet.
+    """
+    path = os.path.join(root, 'labels/minmax.json')
+    if not os.path.exists(path):
+        with open(os.path.join(root, 'labels/minmax.pkl'), 'rb') as fb:
+            minmax_stats = pickle.load(fb)
+        minmax_stats = {k: {s: float(v[s]) for s in ['min', 'max']} for k, v in minmax_stats.items()}
+        with atomic_path(path) as tmp, open(tmp, 'w') as f:
+            json.dump(minmax_stats, f)
+    with open(path, 'r') as f:
+        minmax_stats = json.load(f)
+    return minmax_stats[data_type]['min'], minmax_stats[data_type]['max']
+
+
+class VolumeTransform(nn.Module):
+    """
+    Deterministic part of the pipeline, `Compose([ToTensor(), <intensity>, AddChannel(), Resize(...)])`,
+    as a single torch module, so that volumes never round-trip between numpy and torch.
+    Intensity and resizing follow `ScaleIntensity`, `NormalizeIntensity(nonzero=True)`, `MinMax`
+    and `Resize` (mode='area'). Scriptable with `torch.jit.script`.
+    """
+    size: List[int]
+
+    def __init__(self,
+                 image_size: Optional[int] = None,
+                 intensity: Optional[str] = None,
+                 min_max: tuple = (None, None)):
+        super(VolumeTransform, self).__init__()
+        if intensity not in [None, 'scale', 'normalize', 'minmax']:
+            raise NotImplementedError
+        if intensity == 'minmax':
+            assert all(min_max)
+        self.size = [image_size] * 3 if image_size is not None else []
+        self.intensity = intensity if intensity is not None else 'none'
+        self.xmin = float(min_max[0]) if intensity == 'minmax' else 0.
+        self.xmax = float(min_max[1]) if intensity == 'minmax' else 1.
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.intensity == 'scale':
+            xmin, xmax = x.min(), x.max()
+            if bool(xmin == xmax):
+                x = torch.zeros_like(x)
+            else:
+                x = (x - xmin) / (xmax - xmin)
+        elif self.intensity == 'normalize':
+            mask = x != 0
+            if bool(mask.any()):
+                values = x[mask]
+                std = values.std(unbiased=False)
+                if bool(std == 0):
+                    std = torch.ones_like(std)
+                x = x.masked_scatter(mask, (values - values.mean()) / std)
+        elif self.intensity == 'minmax':
+            x = (x - self.xmin) / (self.xmax - self.xmin)
+        x = x.unsqueeze(0)  # add channel
+        if len(self.size) > 0 and list(x.shape[-3:]) != self.size:  # no-op for volumes already at `image_size`
+            x = F.interpolate(x.unsqueeze(0), size=self.size, mode='area').squeeze(0)
+        return x
+
+
+class GPUAugment(nn.Module):
+    """
+    On-device counterpart of `RandRotate90`, `RandFlip` and `RandGaussianNoise`, applied to a collated
+    batch of shape (B, C, H, W, D) after it has been copied to the GPU. As on the CPU, each augmentation
+    is applied to each sample independently with probability `prob`. Samples are selected with `torch.where`
+    rather than boolean indexing, so that the batch is never synchronized with the host; rotations therefore
+    require H == W, as for the cubic volumes of `make_transforms`.
+    """
+    def __init__(self,
+                 rotate: bool = True,
+                 flip: bool = True,
+                 blur_std: float = 0.1,
+                 prob: float = 0.2):
+        super(GPUAugment, self).__init__()
+        self.rotate = rotate
+        self.flip = flip
+        self.blur_std = blur_std
+        self.prob = prob
+
+    @torch.no_grad()
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        b = x.shape[0]
+        shape = (b, ) + (1, ) * (x.ndim - 1)
+        if self.rotate:
+            # RandRotate90: k ~ {1, 2, 3} quarter turns in the first two spatial axes (k = 0: not rotated)
+            k = torch.randint(1, 4, shape, device=x.device)
+            k = k * (torch.rand(shape, device=x.device) < self.prob)
+            rotated, out = x, x
+            for i in range(1, 4):
+                rotated = torch.rot90(rotated, 1, dims=(2, 3))
+                out = torch.where(k == i, rotated, out)
+            x = out
+        if self.flip:
+            # RandFlip: all spatial axes are flipped
+            mask = torch.rand(shape, device=x.device) < self.prob
+            x = torch.where(mask, torch.flip(x, dims=(2, 3, 4)), x)
+        if self.blur_std:
+            # RandGaussianNoise: std ~ U(0, blur_std) per sample
+            std = torch.rand(shape, device=x.device) * self.blur_std
+            std = std * (torch.rand(shape, device=x.device) < self.prob)
+            x = x + torch.randn_like(x) * std
+        return x
+
+
 def make_transforms(image_size: int = 72,
                     intensity: str = 'scale',
                     min_max: tuple = (None, None),
@@ -40,22 +158,12 @@ def make_transforms(image_size: int = 72,
                     flip: bool = True,
                     affine: bool = True,
                     blur_std: float = 0.1,
-                    prob: float = 0.2):
-
-    base_transform = [ToTensor(),
-                      AddChannel(),
-                      Resize((image_size, image_size, image_size))]
-    if intensity is None:
-        pass
-    elif intensity == 'scale':
-        base_transform.insert(1, ScaleIntensity())
-    elif intensity == 'normalize':
-        base_transform.insert(1, NormalizeIntensity(nonzero=True))
-    elif intensity == 'minmax':
-        assert all(min_max)
-        base_transform.insert(1, MinMax(*min_max))
-    else:
-        raise NotImplementedError
+                    prob: float = 0.2,
+                    dtype: torch.dtype = torch.float32):
+
+    # volumes resized ahead of time (see `BrainProcessor.resize_to_memmap`) use `image_size=None`
+    base_transform = [torch.as_tensor,
+                      torch.jit.script(VolumeTransform(image_size=image_size, intensity=intensity, min_max=min_max))]
 
     train_transform, test_transform = base_transform.copy(), base_transform.copy()
 
@@ -81,43 +189,120 @@ def make_transforms(image_size: int = 72,
     if blur_std:
         train_transform.append(RandGaussianNoise(prob=prob, std=blur_std))
 
-    train_transform.append(ConvertImageDtype(torch.float32))
-    test_transform.append(ConvertImageDtype(torch.float32))
+    # volumes are loaded as float32, and every transform above keeps the dtype;
+    # a smaller `dtype` (e.g., float16) halves the bytes sent to the GPU, where batches are cast back to float32
+    if dtype != torch.float32:
+        train_transform.append(CastToType(dtype=dtype))
+        test_transform.append(CastToType(dtype=dtype))
 
     return Compose(train_transform), Compose(test_transform)
 
 
-def compute_statistics(DATA, normalize_set):
+def make_pipeline(config, min_max: tuple = (None, None), processor=None, datasets: dict = None,
+                  splits: tuple = ('train', 'test')):
+    """
+    Split the preprocessing selected in `config` between the data loader, the CPU transforms and the GPU.
+        crop_first: the loader reads only the center sub-volume, which is resized to `crop_size`.
+        resize_cache: the volumes of `datasets[split]` are resized once with `processor.resize_to_memmap`
+            (e.g., `BrainProcessor`), and the entries of `datasets` are replaced in-place.
+        intensity 'minmax': scaling is fused into the float32 cast of the loader.
+        gpu_augment: rotate / flip / noise are applied to collated batches by a `GPUAugment` module.
+    Returns the train & test transforms, the `GPUAugment` module (None unless `gpu_augment`),
+    and the keyword arguments of the dataset (`crop_ratio`, `min_max`; see `BrainBase`).
+    """
+
+    # crop-first: read only the center sub-volume and resize it to `crop_size`
+    if config.crop_first and config.crop_size:
+        crop_ratio, image_size, crop_size = config.crop_size / config.image_size, config.crop_size, None
+    else:
+        crop_ratio, image_size, crop_size = None, config.image_size, config.crop_size
+
+    # resize once and read the resized volumes from disk (optional)
+    if config.resize_cache:
+        for split in splits:
+            datasets[split] = processor.resize_to_memmap(datasets[split], image_size=image_size,
+                                                         crop_ratio=crop_ratio)
+        crop_ratio, image_size = None, None
+
+    # minmax scaling is fused into the float32 cast of the loader
+    if config.intensity == 'minmax':
+        intensity, loader_min_max = None, min_max
+    else:
+        intensity, loader_min_max = config.intensity, None
+
+    # rotate / flip / noise on the GPU after collation (optional)
+    if config.gpu_augment:
+        augment = GPUAugment(rotate=config.rotate, flip=config.flip, blur_std=config.blur_std, prob=config.prob)
+        rotate, flip, blur_std = False, False, 0.0
+    else:
+        augment, rotate, flip, blur_std = None, config.rotate, config.flip, config.blur_std
+
+    train_transform, test_transform = make_transforms(image_size=image_size,
+                                                      intensity=intensity,
+                                                      min_max=min_max,
+                                                      crop_size=crop_size,
+                                                      rotate=rotate,
+                                                      flip=flip,
+                                                      affine=config.affine,
+                                                      blur_std=blur_std,
+                                                      prob=config.prob,
+                                                      dtype=getattr(torch, config.transfer_dtype))
+
+    return train_transform, test_transform, augment, dict(crop_ratio=crop_ratio, min_max=loader_min_max)
+
+
+def compute_statistics(DATA, normalize_set, num_workers: int = 0, batch_size: int = 16, cache_dir: str = None,
+                       **kwargs):
+    """
+    Mean and std of all voxels in `normalize_set`. Batches are read by `num_workers` DataLoader workers
+    and merged with the parallel (Chan et al.) form of Welford's algorithm, which avoids the cancellation of
+    the sum-of-squares formula. Additional keyword arguments (e.g., `data_type`) are passed to `DATA`.
+    If `cache_dir` is given, the result is stored as `{cache_dir}/{hash}.json`, keyed by the image files.
+    """
+
+    key = hashlib.blake2b(digest_size=16)
+    key.update(repr(([v for _, v in sorted(normalize_set.items()) if isinstance(v, list)],
+                     sorted(kwargs.items()))).encode())
+    path = None if cache_dir is None else os.path.join(cache_dir, f'{key.hexdigest()}.json')
+    if path is not None and os.path.exists(path):
+        with open(path, 'r') as f:
+            stats = json.load(f)
+        return stats['mean'], stats['std']
 
     print('Start computing mean/std of the training dataset')
 
     start_time = time.time()
-    normalize_transform = Compose([ToTensor(), AddChannel()])
-    normalize_set = DATA(dataset=normalize_set, transform=normalize_transform, pin_memory=False)
-    normalize_loader = DataLoader(normalize_set, batch_size=16, shuffle=False, drop_last=False)
+    normalize_transform = Compose([torch.as_tensor, VolumeTransform()])
+    normalize_set = DATA(dataset=normalize_set, transform=normalize_transform, **kwargs)
+    normalize_loader = DataLoader(normalize_set, batch_size=batch_size, shuffle=False, drop_last=False,
+                                  num_workers=num_workers)
 
     count = 0
-    first_moment, second_moment = torch.zeros(1), torch.zeros(1)
+    mean_, m2_ = torch.zeros(1, dtype=torch.float64), torch.zeros(1, dtype=torch.float64)
     for batch in normalize_loader:
         # TODO: calculate non-zero values?
-        x = batch['x'].float()
-        b, _, h, d, w = x.shape
-        num_pixels = b * h * d * w
+        x = batch['x'].double()
+        num_pixels = x.numel()
 
-        sum_ = torch.sum(x)
-        sum_of_square_ = torch.sum(x ** 2)
+        # statistics of the batch, merged into the running (count, mean, M2)
+        batch_mean = x.mean()
+        batch_m2 = torch.sum((x - batch_mean) ** 2)
+        delta = batch_mean - mean_
+        total = count + num_pixels
+        mean_ = mean_ + delta * num_pixels / total
+        m2_ = m2_ + batch_m2 + delta ** 2 * count * num_pixels / total
+        count = total
 
-        first_moment = first_moment + sum_
-        second_moment = second_moment + sum_of_square_
-        count = count + num_pixels
-
-    first_moment = first_moment / count
-    second_moment = second_moment / count
-
-    mean_ = first_moment
-    std_ = torch.sqrt(second_moment - first_moment ** 2)
+    std_ = torch.sqrt(m2_ / count)
     mean_ = mean_.item()
     std_ = std_.item()
     print(f'Mean and std values are computed in {time.time() - start_time:.2f} seconds')
 
+    if path is not None:
+        try:
+            with atomic_path(path) as tmp, open(tmp, 'w') as f:
+                json.dump({'mean': mean_, 'std': std_}, f)
+        except OSError:
+            pass  # read-only data directory; the statistics are simply recomputed next time
+
     return mean_, std_
@@ -16,7 +16,7 @@ class SplitBatchNorm3d(nn.BatchNorm3d):
             running_mean_split = self.running_mean.repeat(self.num_splits)
             running_var_split = self.running_var.repeat(self.num_splits)
             outcome = nn.functional.batch_norm(
-                input.view(-1, C * self.num_splits, D, H, W),
+                input.reshape(-1, C * self.num_splits, D, H, W),
                 running_mean=running_mean_split,
                 running_var=running_var_split,
                 weight=self.weight.repeat(self.num_splits),
@@ -27,7 +27,7 @@ class SplitBatchNorm3d(nn.BatchNorm3d):
             )
             self.running_mean.data.copy_(running_mean_split.view(self.num_splits, C).mean(dim=0))
             self.running_var.data.copy_(running_var_split.view(self.num_splits, C).mean(dim=0))
-            return outcome.view(N, C, D, H, W)
+            return outcome.reshape(N, C, D, H, W)
         else:
             return nn.functional.batch_norm(
                 input, self.running_mean, self.running_var,
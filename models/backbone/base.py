@@ -29,7 +29,18 @@ class BackboneBase(nn.Module):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
 
+_OUT_FEATURES = {}
+
+
 def calculate_out_features(backbone, in_channels, image_size):
-    arr = torch.randn(size=(1, in_channels, image_size, image_size, image_size))
-    out = backbone(arr)
-    return out.shape[1]
+    # cached by architecture (module tree) and input geometry
+    key = (repr(backbone), in_channels, image_size)
+    if key not in _OUT_FEATURES:
+        # eval mode, so the dummy input does not update batch-norm running statistics
+        training = backbone.training
+        backbone.eval()
+        with torch.inference_mode():
+            arr = torch.zeros(size=(1, in_channels, image_size, image_size, image_size))
+            _OUT_FEATURES[key] = backbone(arr).shape[1]
+        backbone.train(training)
+    return _OUT_FEATURES[key]
@@ -2,6 +2,7 @@ import collections
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from models.head.base import HeadBase
 from utils.initialization import initialize_weights
@@ -47,7 +48,12 @@ class LinearClassifier(HeadBase):
         return layers
 
     def forward(self, x: torch.Tensor):
-        return self.layers(x)
+        # functional pooling instead of dispatching through `layers.gap` and `layers.flatten`;
+        # gap -> flatten -> linear then reduces to a pooling kernel followed by a single addmm
+        if self.activation:
+            x = F.relu(x, inplace=True)
+        x = self.layers.dropout(F.adaptive_avg_pool3d(x, 1).flatten(1))
+        return F.linear(x, self.layers.linear.weight, self.layers.linear.bias)
 
     @property
     def num_parameters(self):
@@ -97,7 +103,9 @@ class LinearDemoClassifier(HeadBase):
         return image_layer, classifier
 
     def forward(self, image: torch.Tensor, demo: torch.Tensor):
-        h1 = self.image_layer(image)
+        if self.activation:
+            image = F.relu(image, inplace=True)
+        h1 = F.adaptive_avg_pool3d(image, 1).flatten(1)
         h = torch.concat([h1, demo], dim=1)
         logit = self.classifier(h)
         return logit
@@ -149,7 +157,10 @@ class MLPClassifier(HeadBase):
         return layers
 
     def forward(self, x: torch.Tensor):
-        return self.layers(x)
+        if self.activation:
+            x = F.relu(x, inplace=True)
+        x = self.layers.dropout(F.adaptive_avg_pool3d(x, 1).flatten(1))
+        return self.layers.linear2(F.relu(self.layers.linear1(x), inplace=True))
 
     @property
     def num_parameters(self):
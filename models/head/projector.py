@@ -44,7 +44,8 @@ class LinearHead(HeadBase):
         return layers
 
     def forward(self, x: torch.Tensor):
-        return self.layers(x)
+        x = self.layers.dropout(F.adaptive_avg_pool3d(x, 1).flatten(1))
+        return self.layers.linear(x)
 
     @property
     def num_parameters(self):
@@ -86,7 +87,9 @@ class MLPHead(HeadBase):
         return layers
 
     def forward(self, x: torch.Tensor):
-        return self.layers(x)
+        x = F.adaptive_avg_pool3d(x, 1).flatten(1)
+        x = F.relu(self.layers.bnorm1(self.layers.linear1(x)), inplace=True)
+        return self.layers.linear2(x)
 
     @property
     def num_parameters(self):
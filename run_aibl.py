@@ -6,7 +6,6 @@ import json
 import time
 import rich
 import numpy as np
-import pickle
 import wandb
 import argparse
 
@@ -22,10 +21,13 @@ from models.backbone.resnet import build_resnet_backbone
 from models.head.classifier import LinearClassifier
 
 from datasets.aibl import AIBLProcessor, AIBLDataset
-from datasets.transforms import make_transforms
+from datasets.memmap import share_volume_cache
+from datasets.transforms import make_transforms, load_min_max
 
 from utils.logging import get_rich_logger
-from utils.gpu import set_gpu
+from utils.gpu import set_gpu, setup_runtime
+from utils.compile import compile_module
+from utils.prefetch import prefetch_paths
 
 
 def freeze_bn(module):
@@ -33,8 +35,8 @@ def freeze_bn(module):
         if isinstance(child, nn.BatchNorm3d):
             for param in child.parameters():
                 param.requires_grad = False
-    for n, ch in module.named_children():
-        freeze_bn(ch)
+        else:
+            freeze_bn(child)
 
 
 def main():
@@ -72,6 +74,11 @@ def main():
 
     config.task = config.task + f'_aibl'
 
+    # crop-first loading, resized caches and GPU augmentation (see `datasets.transforms.make_pipeline`)
+    # are only implemented for the ADNI datasets & tasks
+    if config.crop_first or config.resize_cache or config.gpu_augment:
+        raise NotImplementedError('--crop_first, --resize_cache and --gpu_augment are not supported by AIBL.')
+
     set_gpu(config)
     num_gpus_per_node = len(config.gpus)
     world_size = config.num_nodes * num_gpus_per_node
@@ -83,14 +90,6 @@ def main():
     rich.print(config.__dict__)
     config.save()
 
-    np.random.seed(config.random_state)
-    torch.manual_seed(config.random_state)
-
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cudnn.deterministic = False
-    torch.backends.cudnn.allow_tf32 = True
-
     if config.distributed:
         raise NotImplementedError
     else:
@@ -101,7 +100,7 @@ def main():
 def main_worker(local_rank: int, config: argparse.Namespace):
     """Single process."""
 
-    torch.cuda.set_device(local_rank)
+    setup_runtime(local_rank, config)
     if config.distributed:
         raise NotImplementedError
 
@@ -159,10 +158,16 @@ def main_worker(local_rank: int, config: argparse.Namespace):
     # load pretrained model weights
     classifier.load_weights_from_checkpoint(path=config.pretrained_file, key='classifier')
 
+    # fuse conv/bn/relu in the backbone and pooling + linear in the head with TorchInductor
+    if config.compile:
+        compile_module(backbone, dynamic=False, mode=config.compile_mode)
+        compile_module(classifier, dynamic=False, mode=config.compile_mode)
+
     # load finetune data
     data_processor = AIBLProcessor(root=config.root,
                                    data_info=config.data_info,
                                    time_window=config.time_window,
+                                   storage_dtype=config.storage_dtype,
                                    random_state=config.random_state)
     test_only = True if config.train_mode == 'test' else False
     datasets = data_processor.process(n_splits=config.n_splits, n_cv=config.n_cv, test_only=test_only)
@@ -171,9 +176,7 @@ def main_worker(local_rank: int, config: argparse.Namespace):
     assert config.intensity in [None, 'scale', 'minmax', 'normalize']
     mean_std, min_max = (None, None), (None, None)
     if config.intensity == 'minmax':
-        with open(os.path.join(config.root, 'labels/minmax.pkl'), 'rb') as fb:
-            minmax_stats = pickle.load(fb)
-            min_max = (minmax_stats[config.data_type]['min'], minmax_stats[config.data_type]['max'])
+        min_max = load_min_max(config.root, config.data_type)
     else:
         pass
 
@@ -185,7 +188,8 @@ def main_worker(local_rank: int, config: argparse.Namespace):
                                                       flip=config.flip,
                                                       affine=config.affine,
                                                       blur_std=config.blur_std,
-                                                      prob=config.prob)
+                                                      prob=config.prob,
+                                                      dtype=getattr(torch, config.transfer_dtype))
 
     finetune_transform = train_transform if config.finetune_trans == 'train' else test_transform
     if not test_only:
@@ -194,9 +198,20 @@ def main_worker(local_rank: int, config: argparse.Namespace):
         train_set = None
     test_set = AIBLDataset(dataset=datasets['test'], transform=test_transform)
 
+    # one shared-memory cache for all splits, so that a volume used by several of them is stored once
+    if config.cache_images:
+        share_volume_cache([d for d in (train_set, test_set) if d is not None])
+
+    # warm the OS page cache before the DataLoader starts (optional)
+    if config.prefetch_workers > 0:
+        paths = list(test_set.image_files)
+        if train_set is not None:
+            paths += list(train_set.image_files)
+        prefetch_paths(paths, workers=config.prefetch_workers)
+
     # Reconfigure batch-norm layers
     if (config.balance) and (not test_only):
-        class_weight = torch.tensor(data_processor.class_weight, dtype=torch.float).to(local_rank)
+        class_weight = data_processor.class_weight_t.to(local_rank, non_blocking=True)
         loss_function = nn.CrossEntropyLoss(weight=class_weight)
     else:
         loss_function = nn.CrossEntropyLoss()
@@ -5,7 +5,6 @@ import sys
 import time
 import rich
 import numpy as np
-import pickle
 import wandb
 import argparse
 
@@ -21,10 +20,13 @@ from models.backbone.resnet import build_resnet_backbone
 from models.head.classifier import LinearClassifier
 
 from datasets.brain import BrainProcessor, Brain, BrainMoCo
-from datasets.transforms import make_transforms, compute_statistics
+from datasets.memmap import share_volume_cache
+from datasets.transforms import make_pipeline, load_min_max, compute_statistics
 
 from utils.logging import get_rich_logger
-from utils.gpu import set_gpu
+from utils.gpu import set_gpu, setup_runtime
+from utils.compile import compile_module
+from utils.prefetch import prefetch_paths
 
 
 def main():
@@ -42,21 +44,9 @@ def main():
     setattr(config, 'world_size', world_size)
     setattr(config, 'distributed', distributed)
 
-    # str -> list arguments
-    if config.model_name == 'densenet':
-        setattr(config, 'block_config', tuple(int(a) for a in config.block_config.split(',')))
-
     rich.print(config.__dict__)
     config.save()
 
-    np.random.seed(config.random_state)
-    torch.manual_seed(config.random_state)
-
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cudnn.deterministic = False
-    torch.backends.cudnn.allow_tf32 = True
-
     if config.distributed:
         raise NotImplementedError
     else:
@@ -67,7 +57,7 @@ def main():
 def main_worker(local_rank: int, config: argparse.Namespace):
     """Single process."""
 
-    torch.cuda.set_device(local_rank)
+    setup_runtime(local_rank, config)
     if config.distributed:
         raise NotImplementedError
 
@@ -110,12 +100,16 @@ def main_worker(local_rank: int, config: argparse.Namespace):
     else:
         out_dim = calculate_out_features(backbone=backbone, in_channels=1, image_size=config.image_size)
     classifier = LinearClassifier(in_channels=out_dim, num_classes=2, activation=activation)
+    if config.compile:
+        compile_module(backbone, dynamic=False, mode=config.compile_mode)
+        compile_module(classifier, dynamic=False, mode=config.compile_mode)
 
     # load data
     data_processor = BrainProcessor(root=config.root,
                                     data_info=config.data_info,
                                     data_type=config.data_type,
                                     mci_only=config.mci_only,
+                                    storage_dtype=config.storage_dtype,
                                     random_state=config.random_state)
     datasets = data_processor.process(n_splits=config.n_splits, n_cv=config.n_cv)
 
@@ -123,28 +117,30 @@ def main_worker(local_rank: int, config: argparse.Namespace):
     assert config.intensity in [None, 'scale', 'minmax', 'normalize']
     mean_std, min_max = (None, None), (None, None)
     if config.intensity == 'minmax':
-        with open(os.path.join(config.root, 'labels/minmax.pkl'), 'rb') as fb:
-            minmax_stats = pickle.load(fb)
-            min_max = (minmax_stats[config.data_type]['min'], minmax_stats[config.data_type]['max'])
+        min_max = load_min_max(config.root, config.data_type)
     else:
         pass
 
-    train_transform, test_transform = make_transforms(image_size=config.image_size,
-                                                      intensity=config.intensity,
-                                                      min_max=min_max,
-                                                      crop_size=config.crop_size,
-                                                      rotate=config.rotate,
-                                                      flip=config.flip,
-                                                      affine=config.affine,
-                                                      blur_std=config.blur_std,
-                                                      prob=config.prob)
+    train_transform, test_transform, augment, loader_kwargs = make_pipeline(config, min_max=min_max,
+                                                                            processor=data_processor,
+                                                                            datasets=datasets)
+
+    train_set = Brain(dataset=datasets['train'], data_type=config.data_type, transform=train_transform,
+                      **loader_kwargs)
+    test_set = Brain(dataset=datasets['test'], data_type=config.data_type, transform=test_transform,
+                     **loader_kwargs)
+
+    # one shared-memory cache for all splits, so that a volume used by several of them is stored once
+    if config.cache_images:
+        share_volume_cache([train_set, test_set])
 
-    train_set = Brain(dataset=datasets['train'], data_type=config.data_type, transform=train_transform)
-    test_set = Brain(dataset=datasets['test'], data_type=config.data_type, transform=test_transform)
+    # warm the OS page cache before the DataLoader starts (optional)
+    if config.prefetch_workers > 0:
+        prefetch_paths(list(train_set.paths) + list(test_set.paths), workers=config.prefetch_workers)
 
     # Reconfigure batch-norm layers
     if config.balance:
-        class_weight = torch.tensor(data_processor.class_weight, dtype=torch.float).to(local_rank)
+        class_weight = data_processor.class_weight_t.to(local_rank, non_blocking=True)
         loss_function = nn.CrossEntropyLoss(weight=class_weight)
     else:
         loss_function = nn.CrossEntropyLoss()
@@ -163,9 +159,13 @@ def main_worker(local_rank: int, config: argparse.Namespace):
         epochs=config.epochs,
         batch_size=config.batch_size,
         num_workers=config.num_workers,
+        prefetch_factor=config.prefetch_factor,
+        augment=augment,
+        channels_last=config.channels_last,
         distributed=config.distributed,
         local_rank=local_rank,
         mixed_precision=config.mixed_precision,
+        amp_dtype=config.amp_dtype,
         enable_wandb=config.enable_wandb
     )
 
@@ -6,7 +6,6 @@ import json
 import time
 import rich
 import numpy as np
-import pickle
 import wandb
 import argparse
 
@@ -23,10 +22,13 @@ from models.backbone.demoencoder import DemoEncoder
 from models.head.classifier import LinearDemoClassifier
 
 from datasets.brain import BrainProcessor, Brain
-from datasets.transforms import make_transforms
+from datasets.memmap import share_volume_cache
+from datasets.transforms import make_pipeline, load_min_max
 
 from utils.logging import get_rich_logger
-from utils.gpu import set_gpu
+from utils.gpu import set_gpu, setup_runtime
+from utils.compile import compile_module
+from utils.prefetch import prefetch_paths
 
 
 def freeze_bn(module):
@@ -34,8 +36,8 @@ def freeze_bn(module):
         if isinstance(child, nn.BatchNorm3d):
             for param in child.parameters():
                 param.requires_grad = False
-    for n, ch in module.named_children():
-        freeze_bn(ch)
+        else:
+            freeze_bn(child)
 
 
 def main():
@@ -56,7 +58,7 @@ def main():
         # data_parser
         'data_type', 'root', 'data_info', 'mci_only', 'n_splits', 'n_cv',
         'image_size', 'small_kernel', 'random_state',
-        'intensity', 'crop', 'crop_size', 'rotate', 'flip', 'affine', 'blur', 'blur_std', 'prob',
+        'intensity', 'crop', 'crop_size', 'crop_first', 'rotate', 'flip', 'affine', 'blur', 'blur_std', 'prob',
         # model_parser
         'backbone_type', 'init_features', 'growth_rate', 'block_config', 'bn_size', 'dropout_rate',
         'arch', 'no_max_pool',
@@ -85,14 +87,6 @@ def main():
     rich.print(config.__dict__)
     config.save()
 
-    np.random.seed(config.random_state)
-    torch.manual_seed(config.random_state)
-
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cudnn.deterministic = False
-    torch.backends.cudnn.allow_tf32 = True
-
     if config.distributed:
         raise NotImplementedError
     else:
@@ -103,7 +97,7 @@ def main():
 def main_worker(local_rank: int, config: argparse.Namespace):
     """Single process."""
 
-    torch.cuda.set_device(local_rank)
+    setup_runtime(local_rank, config)
     if config.distributed:
         raise NotImplementedError
 
@@ -160,6 +154,7 @@ def main_worker(local_rank: int, config: argparse.Namespace):
                                     mci_only=config.mci_only,
                                     add_apoe=config.add_apoe,
                                     add_volume=config.add_volume,
+                                    storage_dtype=config.storage_dtype,
                                     random_state=config.random_state)
     datasets = data_processor.process(n_splits=config.n_splits, n_cv=config.n_cv)
 
@@ -181,34 +176,40 @@ def main_worker(local_rank: int, config: argparse.Namespace):
     assert config.intensity in [None, 'scale', 'minmax', 'normalize']
     mean_std, min_max = (None, None), (None, None)
     if config.intensity == 'minmax':
-        with open(os.path.join(config.root, 'labels/minmax.pkl'), 'rb') as fb:
-            minmax_stats = pickle.load(fb)
-            min_max = (minmax_stats[config.data_type]['min'], minmax_stats[config.data_type]['max'])
+        min_max = load_min_max(config.root, config.data_type)
     else:
         pass
 
-    train_transform, test_transform = make_transforms(image_size=config.image_size,
-                                                      intensity=config.intensity,
-                                                      min_max=min_max,
-                                                      crop_size=config.crop_size,
-                                                      rotate=config.rotate,
-                                                      flip=config.flip,
-                                                      affine=config.affine,
-                                                      blur_std=config.blur_std,
-                                                      prob=config.prob)
+    train_transform, test_transform, augment, loader_kwargs = make_pipeline(config, min_max=min_max,
+                                                                            processor=data_processor,
+                                                                            datasets=datasets)
 
     finetune_transform = train_transform if config.finetune_trans == 'train' else test_transform
-    train_set = Brain(dataset=datasets['train'], data_type=config.data_type, transform=finetune_transform)
-    test_set = Brain(dataset=datasets['test'], data_type=config.data_type, transform=test_transform)
+    train_set = Brain(dataset=datasets['train'], data_type=config.data_type, transform=finetune_transform,
+                      **loader_kwargs)
+    test_set = Brain(dataset=datasets['test'], data_type=config.data_type, transform=test_transform,
+                     **loader_kwargs)
+
+    # one shared-memory cache for all splits, so that a volume used by several of them is stored once
+    if config.cache_images:
+        share_volume_cache([train_set, test_set])
+
+    # warm the OS page cache before the DataLoader starts (optional)
+    if config.prefetch_workers > 0:
+        prefetch_paths(list(train_set.paths) + list(test_set.paths), workers=config.prefetch_workers)
 
     # Reconfigure batch-norm layers
     if config.balance:
-        class_weight = torch.tensor(data_processor.class_weight, dtype=torch.float).to(local_rank)
+        class_weight = data_processor.class_weight_t.to(local_rank, non_blocking=True)
         loss_function = nn.CrossEntropyLoss(weight=class_weight)
     else:
         loss_function = nn.CrossEntropyLoss()
 
     # Model (Task)
+    if config.compile:
+        compile_module(backbone, dynamic=False, mode=config.compile_mode)
+        compile_module(classifier, dynamic=False, mode=config.compile_mode)
+
     model = DemoClassification(backbone=backbone, demo_encoder=demo_encoder, classifier=classifier)
     model.prepare(
         checkpoint_dir=config.checkpoint_dir,
@@ -222,9 +223,13 @@ def main_worker(local_rank: int, config: argparse.Namespace):
         epochs=config.epochs,
         batch_size=config.batch_size,
         num_workers=config.num_workers,
+        prefetch_factor=config.prefetch_factor,
+        augment=augment if config.finetune_trans == 'train' else None,
+        channels_last=config.channels_last,
         distributed=config.distributed,
         local_rank=local_rank,
         mixed_precision=config.mixed_precision,
+        amp_dtype=config.amp_dtype,
         enable_wandb=config.enable_wandb
     )
 
@@ -5,7 +5,6 @@ import sys
 import time
 import rich
 import numpy as np
-import pickle
 import wandb
 import argparse
 
@@ -23,10 +22,13 @@ from models.head.projector import MLPHead
 from layers.batchnorm import SplitBatchNorm3d
 
 from datasets.brain import BrainProcessor, Brain, BrainMoCo
-from datasets.transforms import make_transforms, compute_statistics
+from datasets.memmap import share_volume_cache
+from datasets.transforms import make_pipeline, load_min_max, compute_statistics
 
 from utils.logging import get_rich_logger
-from utils.gpu import set_gpu
+from utils.gpu import set_gpu, setup_runtime
+from utils.compile import compile_module
+from utils.prefetch import prefetch_paths
 
 
 def main():
@@ -44,25 +46,9 @@ def main():
     setattr(config, 'world_size', world_size)
     setattr(config, 'distributed', distributed)
 
-    # str -> list arguments
-    if config.model_name == 'densenet':
-        setattr(config, 'block_config', tuple(int(a) for a in config.block_config.split(',')))
-    setattr(config, 'knn_k', [int(a) for a in config.knn_k.split(',')])
-    setattr(config, 'alphas', [float(a) for a in config.alphas.split(',')])
-    setattr(config, 'alphas_min', [float(a) for a in config.alphas_min.split(',')])
-    setattr(config, 'alphas_decay_end', [int(a) for a in config.alphas_decay_end.split(',')])
-
     rich.print(config.__dict__)
     config.save()
 
-    np.random.seed(config.random_state)
-    torch.manual_seed(config.random_state)
-
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.benchmark = True
-    torch.backends.cudnn.deterministic = False
-    torch.backends.cudnn.allow_tf32 = True
-
     if config.distributed:
         rich.print(f"Distributed training on {world_size} GPUs.")
         mp.spawn(
@@ -78,7 +64,7 @@ def main():
 def main_worker(local_rank: int, config: argparse.Namespace):
     """Single process."""
 
-    torch.cuda.set_device(local_rank)
+    setup_runtime(local_rank, config)
     if config.distributed:
         dist_rank = config.node_rank * config.num_gpus_per_node + local_rank
         dist.init_process_group(
@@ -138,6 +124,7 @@ def main_worker(local_rank: int, config: argparse.Namespace):
                                     data_info=config.data_info,
                                     data_type=config.data_type,
                                     mci_only=config.mci_only,
+                                    storage_dtype=config.storage_dtype,
                                     random_state=config.random_state)
     datasets = data_processor.process(n_splits=config.n_splits, n_cv=config.n_cv)
 
@@ -145,21 +132,14 @@ def main_worker(local_rank: int, config: argparse.Namespace):
     assert config.intensity in [None, 'scale', 'minmax', 'normalize']
     mean_std, min_max = (None, None), (None, None)
     if config.intensity == 'minmax':
-        with open(os.path.join(config.root, 'labels/minmax.pkl'), 'rb') as fb:
-            minmax_stats = pickle.load(fb)
-            min_max = (minmax_stats[config.data_type]['min'], minmax_stats[config.data_type]['max'])
+        min_max = load_min_max(config.root, config.data_type)
     else:
         pass
 
-    train_transform, test_transform = make_transforms(image_size=config.image_size,
-                                                      intensity=config.intensity,
-                                                      min_max=min_max,
-                                                      crop_size=config.crop_size,
-                                                      rotate=config.rotate,
-                                                      flip=config.flip,
-                                                      affine=config.affine,
-                                                      blur_std=config.blur_std,
-                                                      prob=config.prob)
+    train_transform, test_transform, augment, loader_kwargs = make_pipeline(config, min_max=min_max,
+                                                                            processor=data_processor,
+                                                                            datasets=datasets,
+                                                                            splits=('train', 'u_train', 'test'))
 
     train_set = {}
     for key in datasets['train'].keys():
@@ -170,18 +150,37 @@ def main_worker(local_rank: int, config: argparse.Namespace):
         else:
             raise TypeError
     train_set = BrainMoCo(dataset=train_set, data_type=config.data_type,
-                          query_transform=train_transform, key_transform=train_transform)
-    eval_set = Brain(dataset=datasets['train'], data_type=config.data_type, transform=test_transform)
-    test_set = Brain(dataset=datasets['test'], data_type=config.data_type, transform=test_transform)
+                          query_transform=train_transform, key_transform=train_transform,
+                          **loader_kwargs)
+    eval_set = Brain(dataset=datasets['train'], data_type=config.data_type, transform=test_transform,
+                     **loader_kwargs)
+    test_set = Brain(dataset=datasets['test'], data_type=config.data_type, transform=test_transform,
+                     **loader_kwargs)
+
+    # one shared-memory cache for all splits, so that a volume used by several of them is stored once
+    if config.cache_images:
+        share_volume_cache([train_set, eval_set, test_set])
+
+    # warm the OS page cache before the DataLoader starts (optional)
+    if config.prefetch_workers > 0:
+        prefetch_paths(list(train_set.paths) + list(test_set.paths), workers=config.prefetch_workers)
 
     # Model (Task)
     model = SupMoCo(backbone=backbone,
                     head=projector,
-                    queue=MemoryQueue(size=(config.projector_dim, config.num_negatives), device=local_rank),
+                    queue=MemoryQueue(size=(config.projector_dim, config.num_negatives), device=local_rank,
+                                      dtype=getattr(torch, config.queue_dtype)),
                     loss_function=SupMoCoLoss(temperature=config.temperature,
                                               topk=config.topk,
                                               bottomk=config.bottomk)
                     )
+
+    # compile after the key network has been deep-copied from the query network,
+    # so that each compiled forward is bound to its own network
+    if config.compile:
+        compile_module(model.net_q, dynamic=False, mode=config.compile_mode)
+        compile_module(model.net_k, dynamic=False, mode=config.compile_mode)
+
     model.prepare(
         checkpoint_dir=config.checkpoint_dir,
         optimizer=config.optimizer,
@@ -193,10 +192,15 @@ def main_worker(local_rank: int, config: argparse.Namespace):
         epochs=config.epochs,
         batch_size=config.batch_size,
         num_workers=config.num_workers,
+        prefetch_factor=config.prefetch_factor,
+        augment=augment,
+        channels_last=config.channels_last,
         key_momentum=config.key_momentum,
         distributed=config.distributed,
+        ddp_bucket_mb=config.ddp_bucket_mb,
         local_rank=local_rank,
         mixed_precision=config.mixed_precision,
+        amp_dtype=config.amp_dtype,
         enable_wandb=config.enable_wandb,
         alphas=config.alphas,
         alphas_min=config.alphas_min,
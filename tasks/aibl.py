@@ -12,6 +12,7 @@ from utils.metrics import classification_result
 import wandb
 from utils.logging import make_epoch_description, get_rich_pbar
 from datasets.samplers import ImbalancedDatasetSampler
+from utils.gpu import get_amp_dtype
 from utils.optimization import get_optimizer
 from utils.optimization import get_cosine_scheduler
 
@@ -49,15 +50,19 @@ class AIBL(object):
         self.epochs = self.config.epochs
         self.batch_size = self.config.batch_size
         self.num_workers = self.config.num_workers
+        self.prefetch_factor = self.config.prefetch_factor
         self.local_rank = local_rank
         self.mixed_precision = self.config.mixed_precision
         self.enable_wandb = self.config.enable_wandb
 
+        # channels-last (NDHWC) layout, for which cuDNN has faster Conv3d kernels (optional)
+        self.memory_format = torch.channels_last_3d if self.config.channels_last else torch.preserve_format
+
         # Distributed training (optional)
         if self.config.distributed:
             raise NotImplementedError
         else:
-            self.backbone.to(self.local_rank)
+            self.backbone.to(self.local_rank, memory_format=self.memory_format)
             self.classifier.to(self.local_rank)
 
         # Optimization
@@ -77,7 +82,9 @@ class AIBL(object):
             cycles=self.config.cosine_cycles,
             min_lr=self.config.cosine_min_lr,
             )
-        self.scaler = torch.cuda.amp.GradScaler() if self.mixed_precision else None
+        # bfloat16 has the dynamic range of float32, so its gradients need no loss scaling
+        self.amp_dtype = get_amp_dtype(self.config.amp_dtype)
+        self.scaler = torch.cuda.amp.GradScaler() if self.mixed_precision and self.amp_dtype == torch.float16 else None
 
         # Ready to train!
         self.prepared = True
@@ -94,15 +101,20 @@ class AIBL(object):
             raise RuntimeError("Training not prepared.")
 
         # DataLoader (train, val, test)
+        # workers load `prefetch_factor` batches ahead into pinned memory; only the training loader keeps
+        # its workers alive across epochs, evaluation loaders release theirs (and their buffers) after each pass
+        loader_kwargs = dict(num_workers=self.num_workers, pin_memory=True)
+        if self.num_workers > 0:
+            loader_kwargs.update(prefetch_factor=self.prefetch_factor)
+        persistent_workers = self.num_workers > 0
         if train_set is not None:
             train_sampler = ImbalancedDatasetSampler(dataset=train_set)
             train_loader = DataLoader(dataset=train_set, batch_size=self.batch_size,
-                                      sampler=train_sampler, num_workers=self.num_workers,
-                                      drop_last=True)
+                                      sampler=train_sampler, drop_last=True,
+                                      persistent_workers=persistent_workers, **loader_kwargs)
         else:
             train_loader = None
-        test_loader = DataLoader(dataset=test_set, batch_size=self.batch_size, num_workers=self.num_workers,
-                                 drop_last=False)
+        test_loader = DataLoader(dataset=test_set, batch_size=self.batch_size, drop_last=False, **loader_kwargs)
 
         # Logging
         logger = kwargs.get('logger', None)
@@ -234,9 +246,9 @@ class AIBL(object):
 
             y_true, y_pred = [], []
             for i, batch in enumerate(data_loader):
-                with torch.cuda.amp.autocast(self.mixed_precision):
-                    x = batch['x'].float().to(self.local_rank)
-                    y = batch['y'].to(self.local_rank)
+                with torch.cuda.amp.autocast(self.mixed_precision, dtype=self.amp_dtype):
+                    x = batch['x'].to(self.local_rank, non_blocking=True, memory_format=self.memory_format).float()
+                    y = batch['y'].to(self.local_rank, non_blocking=True)
                     logits = self.classifier(self.backbone(x))
                     loss = self.loss_function(logits, y.long())
                     if self.scaler is not None:
@@ -285,8 +297,8 @@ class AIBL(object):
         y_true, y_pred = [], []
         for i, batch in enumerate(data_loader):
 
-            x = batch['x'].float().to(self.local_rank)
-            y = batch['y'].to(self.local_rank)
+            x = batch['x'].to(self.local_rank, non_blocking=True, memory_format=self.memory_format).float()
+            y = batch['y'].to(self.local_rank, non_blocking=True)
             logits = self.classifier(self.backbone(x))
             loss = self.loss_function(logits, y.long())
 
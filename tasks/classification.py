@@ -11,6 +11,7 @@ from utils.metrics import classification_result
 import wandb
 from utils.logging import make_epoch_description, get_rich_pbar
 from datasets.samplers import ImbalancedDatasetSampler
+from utils.gpu import get_amp_dtype
 from utils.optimization import get_optimizer
 from utils.optimization import get_cosine_scheduler
 
@@ -46,9 +47,13 @@ class Classification(object):
                 epochs: int = 100,
                 batch_size: int = 4,
                 num_workers: int = 4,
+                prefetch_factor: int = 4,
+                augment: nn.Module = None,
+                channels_last: bool = False,
                 distributed: bool = False,
                 local_rank: int = 0,
                 mixed_precision: bool = True,
+                amp_dtype: str = 'float16',
                 enable_wandb: bool = True,
                 **kwargs):  # pylint: disable=unused-argument
 
@@ -58,16 +63,21 @@ class Classification(object):
         self.epochs = epochs
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.augment = augment
         self.distributed = distributed
         self.local_rank = local_rank
         self.mixed_precision = mixed_precision
         self.enable_wandb = enable_wandb
 
+        # channels-last (NDHWC) layout, for which cuDNN has faster Conv3d kernels (optional)
+        self.memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
+
         # Distributed training (optional)
         if distributed:
             raise NotImplementedError
         else:
-            self.backbone.to(self.local_rank)
+            self.backbone.to(self.local_rank, memory_format=self.memory_format)
             self.classifier.to(self.local_rank)
 
         # Optimization
@@ -87,7 +97,9 @@ class Classification(object):
             cycles=cosine_cycles,
             min_lr=cosine_min_lr,
             )
-        self.scaler = torch.cuda.amp.GradScaler() if mixed_precision else None
+        # bfloat16 has the dynamic range of float32, so its gradients need no loss scaling
+        self.amp_dtype = get_amp_dtype(amp_dtype)
+        self.scaler = torch.cuda.amp.GradScaler() if mixed_precision and self.amp_dtype == torch.float16 else None
 
         # Ready to train!
         self.prepared = True
@@ -105,13 +117,18 @@ class Classification(object):
             raise RuntimeError("Training not prepared.")
 
         # DataLoader (train, val, test)
+        # workers load `prefetch_factor` batches ahead into pinned memory; only the training loader keeps
+        # its workers alive across epochs, evaluation loaders release theirs (and their buffers) after each pass
+        loader_kwargs = dict(num_workers=self.num_workers, pin_memory=True)
+        if self.num_workers > 0:
+            loader_kwargs.update(prefetch_factor=self.prefetch_factor)
+        persistent_workers = self.num_workers > 0
         train_sampler = ImbalancedDatasetSampler(dataset=train_set)
         train_loader = DataLoader(dataset=train_set, batch_size=self.batch_size,
-                                  sampler=train_sampler, num_workers=self.num_workers,
-                                  drop_last=True)
+                                  sampler=train_sampler, drop_last=True,
+                                  persistent_workers=persistent_workers, **loader_kwargs)
 
-        test_loader = DataLoader(dataset=test_set, batch_size=self.batch_size, num_workers=self.num_workers,
-                                 drop_last=False)
+        test_loader = DataLoader(dataset=test_set, batch_size=self.batch_size, drop_last=False, **loader_kwargs)
 
         # Logging
         logger = kwargs.get('logger', None)
@@ -212,9 +229,11 @@ class Classification(object):
 
             y_true, y_pred = [], []
             for i, batch in enumerate(data_loader):
-                with torch.cuda.amp.autocast(self.mixed_precision):
-                    x = batch['x'].float().to(self.local_rank)
-                    y = batch['y'].to(self.local_rank)
+                with torch.cuda.amp.autocast(self.mixed_precision, dtype=self.amp_dtype):
+                    x = batch['x'].to(self.local_rank, non_blocking=True, memory_format=self.memory_format).float()
+                    if self.augment is not None:
+                        x = self.augment(x)
+                    y = batch['y'].to(self.local_rank, non_blocking=True)
                     logits = self.classifier(self.backbone(x))
                     loss = self.loss_function(logits, y.long())
                     if self.scaler is not None:
@@ -263,8 +282,8 @@ class Classification(object):
         y_true, y_pred = [], []
         for i, batch in enumerate(data_loader):
 
-            x = batch['x'].float().to(self.local_rank)
-            y = batch['y'].to(self.local_rank)
+            x = batch['x'].to(self.local_rank, non_blocking=True, memory_format=self.memory_format).float()
+            y = batch['y'].to(self.local_rank, non_blocking=True)
             logits = self.classifier(self.backbone(x))
             loss = self.loss_function(logits, y.long())
 
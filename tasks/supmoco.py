@@ -16,6 +16,7 @@ from utils.distributed import ForMoCo
 from utils.distributed import concat_all_gather
 from utils.metrics import TopKAccuracy
 from utils.knn import KNNEvaluator, BinaryKNN
+from utils.gpu import get_amp_dtype
 from utils.optimization import get_optimizer
 from utils.optimization import get_cosine_scheduler
 from utils.logging import get_rich_pbar, make_epoch_description
@@ -48,7 +49,9 @@ class SupMoCoLoss(nn.Module):
 
         # Calculate logits
         pos_logits = torch.einsum('nc,nc->n', [queries, keys]).view(-1, 1)
-        neg_logits = torch.einsum('nc,ck->nk', [queries, queue.buffer.clone().detach()])
+        # the queue is only updated after backpropagation, so it is read without a copy
+        neg_logits = torch.einsum('nc,ck->nk', [queries.to(queue.buffer.dtype), queue.buffer.detach()])
+        neg_logits = neg_logits.to(pos_logits.dtype)
         logits = torch.cat([pos_logits, neg_logits], dim=1)  # (B, 1+K)
         logits.div_(self.temperature)
 
@@ -74,7 +77,7 @@ class SupMoCoLoss(nn.Module):
 
 
 class MemoryQueue(nn.Module):
-    def __init__(self, size: tuple, device: int = 0):
+    def __init__(self, size: tuple, device: int = 0, dtype: torch.dtype = torch.float32):
         super(MemoryQueue, self).__init__()
 
         if len(size) != 2:
@@ -84,9 +87,10 @@ class MemoryQueue(nn.Module):
 
         with torch.no_grad():
             self.buffer = torch.randn(*self.size, device=self.device)  # (f, K)
-            self.buffer = F.normalize(self.buffer, dim=0)              # l2 normalize
+            self.buffer = F.normalize(self.buffer, dim=0).to(dtype)    # l2 normalize
             self.ptr = torch.zeros(1, dtype=torch.long, device=self.device)
             self.labels = torch.full((self.size[1], ), fill_value=-1, dtype=torch.long, device=self.device)
+        self._ptr = 0  # host-side copy of `self.ptr`, read without a device synchronization
         self.num_updates = 0
         self.is_reliable = False
 
@@ -107,15 +111,18 @@ class MemoryQueue(nn.Module):
         # Gather along multiple processes.
         keys = concat_all_gather(keys)  # (B, f) -> (world_size * B, f)
         incoming, _ = keys.size()
-        if self.num_negatives % incoming != 0:
-            raise ValueError("Use exponentials of 2 for number of negatives.")
-
-        # Update queue (keys, and optionally labels if provided)
-        ptr = int(self.ptr)
-        self.buffer[:, ptr: ptr + incoming] = keys.T
+        if incoming > self.num_negatives:
+            raise ValueError("Number of negatives must not be smaller than the (global) batch size.")
+
+        # Update queue (keys, and optionally labels if provided) in-place, wrapping around at the end
+        ptr = self._ptr
+        head = min(incoming, self.num_negatives - ptr)
+        self.buffer[:, ptr: ptr + head] = keys[:head].T
+        self.buffer[:, :incoming - head] = keys[head:].T
         if labels is not None:
             labels = concat_all_gather(labels)  # (B, ) -> (world_size * B, )
-            self.labels[ptr: ptr + incoming] = labels
+            self.labels[ptr: ptr + head] = labels[:head]
+            self.labels[:incoming - head] = labels[head:]
 
         # Check if the current queue is reliable
         if not self.is_reliable:
@@ -124,6 +131,7 @@ class MemoryQueue(nn.Module):
         # Update pointer
         ptr = (ptr + incoming) % self.num_negatives
         self.ptr[0] = ptr
+        self._ptr = ptr
         self.num_updates += 1
 
 
@@ -164,10 +172,15 @@ class SupMoCo(object):
                 epochs: int = 1000,
                 batch_size: int = 16,
                 num_workers: int = 4,
+                prefetch_factor: int = 4,
+                augment: nn.Module = None,
+                channels_last: bool = False,
                 key_momentum: float = 0.999,
                 distributed: bool = False,
+                ddp_bucket_mb: int = 25,
                 local_rank: int = 0,
                 mixed_precision: bool = False,
+                amp_dtype: str = 'float16',
                 enable_wandb: bool = True,
                 resume: str = None,
                 alphas: list = [1.0, 0.50],
@@ -181,6 +194,8 @@ class SupMoCo(object):
         self.epochs = epochs
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.augment = augment
         self.key_momentum = key_momentum
         self.distributed = distributed
         self.local_rank = local_rank
@@ -191,6 +206,9 @@ class SupMoCo(object):
         self.alphas_min = alphas_min
         self.alphas_decay_end = alphas_decay_end
 
+        # channels-last (NDHWC) layout, for which cuDNN has faster Conv3d kernels (optional)
+        self.memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
+
         self.optimizer = get_optimizer(
             params=self.net_q.parameters(),
             name=optimizer,
@@ -216,17 +234,22 @@ class SupMoCo(object):
         # Distributed training (optional, disabled by default.)
         if distributed:
             self.net_q = DistributedDataParallel(
-                module=self.net_q.to(local_rank),
-                device_ids=[local_rank]
+                module=self.net_q.to(local_rank, memory_format=self.memory_format),
+                device_ids=[local_rank],
+                bucket_cap_mb=ddp_bucket_mb,
+                gradient_as_bucket_view=True,   # no copy between gradients and all-reduce buckets
+                static_graph=True,              # the same parameters are used at every step
             )
         else:
-            self.net_q.to(local_rank)
+            self.net_q.to(local_rank, memory_format=self.memory_format)
 
         # No DDP wrapping for key encoder, as it does not have gradients
-        self.net_k.to(local_rank)
+        self.net_k.to(local_rank, memory_format=self.memory_format)
 
         # Mixed precision training (optional, enabled by default.)
-        self.scaler = torch.cuda.amp.GradScaler() if mixed_precision else None
+        # bfloat16 has the dynamic range of float32, so its gradients need no loss scaling
+        self.amp_dtype = get_amp_dtype(amp_dtype)
+        self.scaler = torch.cuda.amp.GradScaler() if mixed_precision and self.amp_dtype == torch.float16 else None
 
         # alpha factor
         self.muls = []
@@ -245,6 +268,12 @@ class SupMoCo(object):
             raise RuntimeError("Training not prepared.")
 
         # DataLoader (for self-supervised pre-training)
+        # workers load `prefetch_factor` batches ahead into pinned memory; only the training loader keeps
+        # its workers alive across epochs, evaluation loaders release theirs (and their buffers) after each pass
+        loader_kwargs = dict(num_workers=self.num_workers, pin_memory=True)
+        if self.num_workers > 0:
+            loader_kwargs.update(prefetch_factor=self.prefetch_factor)
+        persistent_workers = self.num_workers > 0
         sampler = DistributedSampler(dataset) if self.distributed else None
         shuffle = not self.distributed
         train_loader = DataLoader(
@@ -252,14 +281,14 @@ class SupMoCo(object):
             batch_size=self.batch_size,
             sampler=sampler,
             shuffle=shuffle,
-            num_workers=self.num_workers,
             drop_last=True,
-            pin_memory=True
+            persistent_workers=persistent_workers,
+            **loader_kwargs
         )
 
         # DataLoader (for supervised evaluation): memory_loader -> validation set & query_loader -> test set
-        memory_loader = DataLoader(memory_set, batch_size=self.batch_size, num_workers=self.num_workers)
-        query_loader = DataLoader(query_set, batch_size=self.batch_size, num_workers=self.num_workers)
+        memory_loader = DataLoader(memory_set, batch_size=self.batch_size, **loader_kwargs)
+        query_loader = DataLoader(query_set, batch_size=self.batch_size, **loader_kwargs)
 
         # Logging
         logger = kwargs.get('logger', None)
@@ -377,11 +406,13 @@ class SupMoCo(object):
     def train_step(self, batch: dict):
         """A single forward & backward pass."""
 
-        with torch.cuda.amp.autocast(self.mixed_precision):
+        with torch.cuda.amp.autocast(self.mixed_precision, dtype=self.amp_dtype):
             # Get data (two views)
-            x_q = batch['x1'].to(self.local_rank)
-            x_k = batch['x2'].to(self.local_rank)
-            y = batch['y'].to(self.local_rank)
+            x_q = batch['x1'].to(self.local_rank, non_blocking=True, memory_format=self.memory_format).float()
+            x_k = batch['x2'].to(self.local_rank, non_blocking=True, memory_format=self.memory_format).float()
+            y = batch['y'].to(self.local_rank, non_blocking=True)
+            if self.augment is not None:
+                x_q, x_k = self.augment(x_q), self.augment(x_k)
 
             # Compute query features; (B, f)
             z_q = F.normalize(self.net_q(x_q), dim=1)
@@ -439,8 +470,10 @@ class SupMoCo(object):
 
     @torch.no_grad()
     def _momentum_update_key_net(self):
-        for p_q, p_k in zip(self.net_q.parameters(), self.net_k.parameters()):
-            p_k.data = p_k.data * self.key_momentum + p_q.data * (1. - self.key_momentum)
+        # in-place multi-tensor kernels; a few launches for all parameters instead of several per parameter
+        params_q, params_k = list(self.net_q.parameters()), list(self.net_k.parameters())
+        torch._foreach_mul_(params_k, self.key_momentum)
+        torch._foreach_add_(params_k, params_q, alpha=1. - self.key_momentum)
 
     def save_checkpoint(self, path: str, **kwargs):
         """Save model to a `.tar' checkpoint file."""
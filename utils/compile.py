@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+
+import torch
+import torch.nn as nn
+
+
+def compile_module(module: nn.Module, **kwargs):
+    """
+    Compile `module.forward` with TorchInductor, in-place.
+    Unlike `torch.compile(module)`, the module is not wrapped, so parameter names (and therefore
+    checkpoints) are unchanged. Falls back to eager execution if compilation is unavailable.
+    `torch.compile` is lazy and only fails on the first call, so Dynamo is told to suppress compilation
+    errors there (and run the failing frames eagerly) instead of raising in the middle of training.
+    Note that the compiled forward is bound to `module`; compile after any `copy.deepcopy`.
+    """
+    if not (hasattr(torch, 'compile') and torch.cuda.is_available()):
+        return module
+    try:
+        import torch._dynamo
+        torch._dynamo.config.suppress_errors = True
+        module.forward = torch.compile(module.forward, **kwargs)
+    except Exception as e:  # pylint: disable=broad-except
+        warnings.warn(f"torch.compile is not available for {type(module).__name__}, running eagerly: {e}")
+    return module
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import contextlib
+
+import torch.distributed as dist
+
+
+@contextlib.contextmanager
+def atomic_path(path: str):
+    """
+    Yield a temporary path in the directory of `path`, which is moved onto `path` with `os.replace`
+    only once the block completes. An interrupted write (or several processes writing the same file)
+    never leaves a truncated file behind that later runs would take for a complete cache.
+    The temporary file keeps the extension of `path`, since `np.save` & `np.savez` append theirs otherwise.
+    """
+    directory, name = os.path.split(path)
+    os.makedirs(directory or '.', exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix=f'.{name}.', suffix=os.path.splitext(name)[1])
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+@contextlib.contextmanager
+def rank_zero_first():
+    """
+    Yield True on the process which should do the work (rank 0, or the only process), False on the others,
+    which wait at a barrier until rank 0 has left the block.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    is_main = (not distributed) or dist.get_rank() == 0
+    try:
+        yield is_main
+    finally:
+        if distributed:
+            dist.barrier()
@@ -1,4 +1,6 @@
 import os
+import numpy as np
+import torch
 
 STR2GPU = {'00': 'MIG-f3304720-4601-5894-bee4-cd0174024e06',
            '10': 'MIG-35d812cd-2b57-5e55-bb30-890bd9675846',
@@ -9,6 +11,13 @@ STR2GPU = {'00': 'MIG-f3304720-4601-5894-bee4-cd0174024e06',
 
 
 def set_gpu(config):
+    """
+    Restrict the visible devices to `config.gpus`.
+    CUDA reads `CUDA_VISIBLE_DEVICES` once, when it is initialized (lazily, not at `import torch`),
+    so this must be called before the first CUDA call; otherwise it would be silently ignored.
+    """
+    if torch.cuda.is_initialized():
+        raise RuntimeError("CUDA is already initialized; call `set_gpu` before the first CUDA call.")
     if config.server == 'workstation2':
         gpus = ','.join([STR2GPU[str(gpu)] for gpu in config.gpus])
     else:
@@ -16,6 +25,30 @@ def set_gpu(config):
     os.environ['CUDA_VISIBLE_DEVICES'] = gpus
 
 
+def get_amp_dtype(name: str):
+    """Data type of mixed precision; 'auto' chooses bfloat16 on devices which support it, float16 otherwise."""
+    if name == 'auto':
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return getattr(torch, name)
+
+
+def setup_runtime(local_rank: int, config):
+    """
+    Seed the random number generators, enable TF32 & cuDNN autotuning and select the device.
+    Called at the start of every worker; processes started by `mp.spawn` do not inherit these settings.
+    """
+    np.random.seed(config.random_state)
+    torch.manual_seed(config.random_state)
+
+    torch.set_float32_matmul_precision('high')  # TF32 tensor cores for float32 matmuls (Ampere or newer)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cudnn.allow_tf32 = True
+
+    torch.cuda.set_device(local_rank)
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -5,7 +5,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from sklearn.neighbors import KNeighborsClassifier
 from sklearn.metrics import roc_auc_score
 from torchmetrics.functional import precision, recall, confusion_matrix
 
@@ -13,11 +12,59 @@ from utils.logging import get_rich_pbar
 from utils.metrics import classification_result
 
 
+def _normalize_(z: torch.FloatTensor):
+    """In-place equivalent of `F.normalize(z, dim=1)`, which would allocate a second (B, F) tensor."""
+    return z.div_(z.norm(dim=1, keepdim=True).clamp_min_(1e-12))
+
+
+class _Prefetcher(object):
+    """
+    Wraps a `DataLoader` of dict batches and copies the next batch to `device` on a side stream,
+    while the current one is processed on the default stream. Requires `pin_memory=True`.
+    """
+    def __init__(self, loader: torch.utils.data.DataLoader, device: torch.device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+        prev = None
+        for batch in self.loader:
+            with torch.cuda.stream(self.stream):
+                batch = {k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v
+                         for k, v in batch.items()}
+                event = torch.cuda.Event()
+                event.record(self.stream)
+            if prev is not None:
+                yield self._wait(*prev)
+            prev = batch, event
+        if prev is not None:
+            yield self._wait(*prev)
+
+    def _wait(self, batch: dict, event):
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(stream)  # allocated on the side stream, used on the default stream
+        return batch
+
+
 class KNNEvaluator(object):
     def __init__(self,
                  num_neighbors: int or list,
                  num_classes: int,
-                 temperature: float = 0.1):
+                 temperature: float = 0.1,
+                 chunk_size: int = 1024,
+                 dtype: torch.dtype = torch.float16,
+                 use_faiss: bool = False,
+                 use_softmax_weights: bool = True):
         
         if isinstance(num_neighbors, int):
             self.num_neighbors = [num_neighbors]
@@ -27,6 +74,10 @@ class KNNEvaluator(object):
             raise NotImplementedError
         self.num_classes = num_classes
         self.temperature = temperature
+        self.chunk_size = chunk_size  # number of queries per similarity matrix; bounds memory to (chunk_size, M)
+        self.dtype = dtype            # of the memory bank on cuda; normalized features lie in [-1, 1]
+        self.use_faiss = use_faiss    # search with a fused FAISS index (optional dependency) instead of GEMM + topk
+        self.use_softmax_weights = use_softmax_weights  # weight votes by exp(sim / T); (1 + sim) / 2 otherwise
 
     @torch.no_grad()
     def evaluate(self,
@@ -43,6 +94,8 @@ class KNNEvaluator(object):
             query_loader: a `DataLoader` instance of test data. Apply
                     minimal data augmentation as used for testing for linear evaluation.
                     (i.e., Resize + Crop (0.875 x size), etc.)
+            Both loaders should use `pin_memory=True`; otherwise the non-blocking
+            host-to-device copies of `x` and `y` fall back to synchronous ones.
         """
 
         net.eval()
@@ -56,31 +109,47 @@ class KNNEvaluator(object):
             task_2 = pg.add_task(desc_2, total=len(query_loader))
 
             # 1. Extract memory features (train data to compare against)
-            memory_bank, memory_labels = [], []
-            for _, batch in enumerate(memory_loader):
-                z = net(batch['x'].to(device, non_blocking=True))
-                memory_bank += [F.normalize(z, dim=1)]
-                memory_labels += [batch['y'].to(device)]
+            #  written in place into tensors allocated on the first batch, instead of list + cat
+            memory_bank, memory_labels, M = None, None, 0
+            for _, batch in enumerate(_Prefetcher(memory_loader, device)):
+                z = _normalize_(net(batch['x'].to(device, non_blocking=True).float()))
+                y = batch['y'].to(device, non_blocking=True)
+                if memory_bank is None:
+                    N = len(memory_loader.dataset)
+                    dtype = self.dtype if device.type == 'cuda' else z.dtype
+                    memory_bank = torch.empty(N, z.size(1), device=device, dtype=dtype)  # (M, F)
+                    memory_labels = torch.empty(N, device=device, dtype=y.dtype)
+                memory_bank[M:M + len(z)] = z
+                memory_labels[M:M + len(y)] = y
+                M += len(z)
                 pg.update(task_1, advance=1.)
 
-            memory_bank = torch.cat(memory_bank, dim=0).T
-            memory_labels = torch.cat(memory_labels, dim=0)
+            memory_bank = memory_bank[:M]                                    # in case of drop_last
+            memory_labels = memory_labels[:M].long()                         # int64 once, for indexing & scatter
+            index = self._build_faiss_index(memory_bank) if self.use_faiss else None
 
             # 2. Extract query features (test data to evaluate) and
             #  and evalute against memory features.
             scores = dict()
-            corrects = [0] * len(self.num_neighbors)
-            for _, batch in enumerate(query_loader):
-                z = F.normalize(net(batch['x'].to(device)), dim=1)
-                y = batch['y'].to(device)
-                for i, k in enumerate(self.num_neighbors):
-                    y_pred = self.predict(k,
-                                          query=z,
-                                          memory_bank=memory_bank,
-                                          memory_labels=memory_labels)[:, 0].squeeze()
-                    corrects[i] += y.eq(y_pred).sum().item()
+            corrects = torch.zeros(len(self.num_neighbors), device=device, dtype=torch.long)
+            top1 = (max(self.num_neighbors) == 1) and (index is None)
+            for _, batch in enumerate(_Prefetcher(query_loader, device)):
+                z = _normalize_(net(batch['x'].to(device, non_blocking=True).float()))
+                y = batch['y'].to(device, non_blocking=True)
+                if top1:
+                    y_pred = self._predict_top1(z, memory_bank, memory_labels).unsqueeze(1)  # (b, 1)
+                else:
+                    sim_weight, sim_labels = self._topk_sims(max(self.num_neighbors),
+                                                             query=z,
+                                                             memory_bank=memory_bank,
+                                                             memory_labels=memory_labels,
+                                                             index=index)
+                    votes = self._weighted_votes(sim_weight, sim_labels, self.num_neighbors)
+                    y_pred = votes.argmax(dim=-1)                              # (b, len(num_neighbors))
+                corrects += y_pred.eq(y.unsqueeze(1)).sum(dim=0)               # no sync until the end
                 pg.update(task_2, advance=1.) 
             
+            corrects = corrects.tolist()
             for i, k in enumerate(self.num_neighbors):
                 scores[f'knn@{k}'] = corrects[i] / len(query_loader.dataset)
 
@@ -92,29 +161,88 @@ class KNNEvaluator(object):
                 query: torch.FloatTensor,
                 memory_bank: torch.FloatTensor,
                 memory_labels: torch.LongTensor):
+        sim_weight, sim_labels = self._topk_sims(k, query, memory_bank, memory_labels.long())
+        return self._weighted_votes(sim_weight, sim_labels, [k])[:, 0].argmax(dim=-1)  # (b, )
 
-        C = self.num_classes
-        T = self.temperature
-        B, _ = query.size()
+    def _topk_sims(self,
+                   k: int,
+                   query: torch.FloatTensor,
+                   memory_bank: torch.FloatTensor,
+                   memory_labels: torch.LongTensor,
+                   index=None):
+        """
+        Similarities & labels of the k nearest memory entries, sorted in descending order.
+        Prefixes `[:, :k']` give the neighbors for any smaller k', so this is computed once for all k.
+        If a FAISS `index` of the memory bank is given, the search is delegated to it.
+        """
+        k = min(k, memory_bank.size(0))
 
-        # Compute cosine similarity
-        sim_matrix = torch.einsum('bf,fm->bm', [query, memory_bank])       # (b, f) @ (f, M) -> (b, M)
-        sim_weight, sim_indices = sim_matrix.sort(dim=1, descending=True)  # (b, M), (b, M)
-        sim_weight, sim_indices = sim_weight[:, :k], sim_indices[:, :k]    # (b, k), (b, k)
-        sim_weight = (sim_weight / T).exp()                                # (b, k)
-        sim_labels = torch.gather(
-            memory_labels.expand(B, -1),                                   # (1, M) -> (b, M)
-            dim=1,
-            index=sim_indices
-        )                                                                  # (b, M)
+        if index is not None:
+            # torch tensors in and out (faiss.contrib.torch_utils); a gpu index searches device memory directly
+            q = query.float().contiguous()
+            sim_weight, sim_indices = index.search(q if self._faiss_gpu else q.cpu(), k)  # (b, k), (b, k)
+            return sim_weight.to(query.device), memory_labels[sim_indices.to(query.device)]
 
-        one_hot = torch.zeros(B * k, C, device=sim_labels.device)          # (bk, C)
-        sim_labels = sim_labels.type(torch.int64)                          # error occurred in imagenet32
-        one_hot.scatter_(dim=-1, index=sim_labels.view(-1, 1), value=1)    # (bk, C) <- scatter <- (bk, 1)
-        pred = one_hot.view(B, k, C) * sim_weight.unsqueeze(dim=-1)        # (b, k, C) * (b, k, 1)
-        pred = pred.sum(dim=1)                                             # (b, C)
+        # Compute cosine similarity, a chunk of queries at a time
+        sim_weight, sim_indices = [], []
+        for q in query.split(self.chunk_size):
+            sim_matrix = torch.mm(q.to(memory_bank.dtype), memory_bank.T)  # (c, f) @ (M, f)^T -> (c, M)
+            w, i = sim_matrix.topk(k, dim=1)                               # (c, k), (c, k)
+            sim_weight += [w.float()]
+            sim_indices += [i]
+            del sim_matrix
+        sim_weight, sim_indices = torch.cat(sim_weight), torch.cat(sim_indices)  # (b, k), (b, k)
+        sim_labels = memory_labels[sim_indices]                            # (b, k)
 
-        return pred.argsort(dim=-1, descending=True)                       # (b, C); first column gives label of highest confidence
+        return sim_weight, sim_labels
+
+    def _predict_top1(self,
+                      query: torch.FloatTensor,
+                      memory_bank: torch.FloatTensor,
+                      memory_labels: torch.LongTensor):
+        """Label of the nearest memory entry; with a single neighbor the weighted vote reduces to this."""
+        indices = [torch.mm(q.to(memory_bank.dtype), memory_bank.T).argmax(dim=1)
+                   for q in query.split(self.chunk_size)]
+        return memory_labels[torch.cat(indices)]                           # (b, )
+
+    def _build_faiss_index(self, memory_bank: torch.FloatTensor):
+        """Exact inner product (= cosine similarity) index of the memory bank, on the same gpu if possible."""
+        import faiss
+        import faiss.contrib.torch_utils  # noqa: F401; lets `add` & `search` take torch tensors
+        index = faiss.IndexFlatIP(memory_bank.size(1))
+        self._faiss_gpu = memory_bank.is_cuda and hasattr(faiss, 'StandardGpuResources')
+        if self._faiss_gpu:
+            self._faiss_resources = faiss.StandardGpuResources()  # must outlive the index
+            index = faiss.index_cpu_to_gpu(self._faiss_resources, memory_bank.device.index, index)
+        bank = memory_bank.float().contiguous()
+        index.add(bank if self._faiss_gpu else bank.cpu())
+        return index
+
+    def _vote_weights(self, sim_weight: torch.FloatTensor):
+        if self.use_softmax_weights:
+            return (sim_weight / self.temperature).exp()
+        # cosine similarities mapped to [0, 1]; a negative vote would rank below the zero of unvoted classes
+        return (1 + sim_weight) / 2
+
+    def _weighted_votes(self,
+                        sim_weight: torch.FloatTensor,
+                        sim_labels: torch.LongTensor,
+                        num_neighbors: list):
+        """
+        Weighted class votes of the first k neighbors, for every k in `num_neighbors`.
+        Each k scatters its prefix of the sorted neighbors into its own row; no (b, k, C) tensor is built.
+        """
+
+        C = self.num_classes
+        B, K = sim_weight.size()
+
+        sim_weight = self._vote_weights(sim_weight)                        # (b, K)
+        votes = torch.zeros(B, len(num_neighbors), C, device=sim_weight.device, dtype=sim_weight.dtype)
+        for i, k in enumerate(num_neighbors):
+            k = min(k, K)
+            votes[:, i].scatter_add_(dim=1, index=sim_labels[:, :k], src=sim_weight[:, :k])  # (b, C) <- (b, k)
+
+        return votes                                                       # (b, len(num_neighbors), C)
 
 
 class BinaryKNN(object):
@@ -142,33 +270,42 @@ class BinaryKNN(object):
             task = pg.add_task(desc, total=len(train_loader) + len(test_loader))
 
             # 1. Extract features of training data
-            train_z, labels_train = [], []
-            for batch in train_loader:
-                z = net(batch['x'].to(device, non_blocking=True))
-                train_z += [F.normalize(z, dim=1).cpu().numpy()]
-                labels_train += [batch['y'].cpu().numpy()]
-                pg.update(task, advance=1.)
-            train_z = np.concatenate(train_z, axis=0)
-            labels_train = np.concatenate(labels_train, axis=0)
+            train_z, labels_train = self._extract_features(net, train_loader, device, pg=pg, task=task)
 
             # 2. Extract features of testing data
-            test_z, labels_test = [], []
-            for batch in test_loader:
-                z = net(batch['x'].to(device, non_blocking=True))
-                test_z += [F.normalize(z, dim=1).cpu().numpy()]
-                labels_test += [batch['y'].to(device).cpu().numpy()]
-                pg.update(task, advance=1.)
-            test_z = np.concatenate(test_z, axis=0)
-            labels_test = np.concatenate(labels_test, axis=0)
+            test_z, labels_test = self._extract_features(net, test_loader, device, pg=pg, task=task)
+
+        # k-nn; uniform votes of the nearest training samples under cosine similarity,
+        #  as in sklearn's KNeighborsClassifier(metric='cosine'), with a single GEMM + topk for all k
+        k_max = min(max(self.num_neighbors), len(train_z))
+        sim_indices = torch.mm(test_z, train_z.T).topk(k_max, dim=1).indices  # (N_test, k)
+        sim_labels = labels_train[sim_indices].long()                         # (N_test, k)
+        labels_test = labels_test.cpu().numpy()
 
-        # k-nn
         scores = dict()
         for num_neighbor in self.num_neighbors:
-            knn = KNeighborsClassifier(n_neighbors=num_neighbor, metric='cosine')
-            knn.fit(train_z, labels_train)
-            y_pred = knn.predict_proba(test_z)
+            votes = F.one_hot(sim_labels[:, :num_neighbor], num_classes=self.num_classes)
+            y_pred = votes.float().mean(dim=1).cpu().numpy()                  # (N_test, C)
             result = classification_result(y_true=labels_test,
                                            y_pred=y_pred,
                                            adjusted=adjusted)
             scores[f'knn@{num_neighbor}'] = result
         return scores
+
+    @staticmethod
+    def _extract_features(net, loader, device, pg=None, task=None):
+        """Normalized features & labels on `device`, written in place instead of list + concatenate."""
+        z_all, y_all, n = None, None, 0
+        for batch in _Prefetcher(loader, device):
+            z = _normalize_(net(batch['x'].to(device, non_blocking=True).float()))
+            y = batch['y'].to(device, non_blocking=True)
+            if z_all is None:
+                N = len(loader.dataset)
+                z_all = torch.empty(N, z.size(1), device=device, dtype=z.dtype)
+                y_all = torch.empty(N, device=device, dtype=y.dtype)
+            z_all[n:n + len(z)] = z
+            y_all[n:n + len(y)] = y
+            n += len(z)
+            if pg is not None:
+                pg.update(task, advance=1.)
+        return z_all[:n], y_all[:n]  # in case of drop_last
@@ -2,8 +2,11 @@
 
 import os
 import sys
+import queue
+import atexit
 import shutil
 import logging
+import logging.handlers
 
 from rich.console import Console
 from rich.progress import Progress
@@ -35,24 +38,39 @@ def get_rich_pbar(transient: bool = True, auto_refresh: bool = False):
     )
 
 
-def get_rich_logger(logfile: str = None, level=logging.INFO):
-    """A colorful logger based on the `rich` python library."""
+def get_rich_logger(logfile: str = None, level=logging.INFO, asynchronous: bool = True):
+    """
+    A colorful logger based on the `rich` python library.
+    If `asynchronous`, records are only enqueued by the calling (training) thread,
+    and formatted & written by a background listener thread.
+    """
 
     myLogger = logging.getLogger()
+    handlers = []
 
     # File handler
     if logfile is not None:
         touch(logfile)
         fileHandler = logging.FileHandler(logfile)
         fileHandler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)-5.5s] %(message)s"))
-        myLogger.addHandler(fileHandler)
+        handlers.append(fileHandler)
 
     # Rich handler
     width, _ = shutil.get_terminal_size()
     console = Console(color_system='256', width=width)
     richHandler = RichHandler(console=console)
     richHandler.setFormatter(logging.Formatter("%(message)s"))
-    myLogger.addHandler(richHandler)
+    handlers.append(richHandler)
+
+    if asynchronous:
+        records = queue.Queue()
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # flush the remaining records on exit
+        handlers = [logging.handlers.QueueHandler(records)]
+
+    for handler in handlers:
+        myLogger.addHandler(handler)
 
     # Set level
     myLogger.setLevel(level)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+
+
+def populate(path: str):
+    """Read a file into the OS page cache and return its size in bytes."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        if hasattr(mmap, 'MAP_POPULATE'):
+            # the kernel faults in the whole mapping before mmap returns
+            with mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED | mmap.MAP_POPULATE, prot=mmap.PROT_READ):
+                pass
+        else:
+            while f.read(1 << 24):
+                pass
+    return size
+
+
+def prefetch_paths(paths: list, workers: int = 16):
+    """
+    Warm the OS page cache with the given files before training starts.
+    Many outstanding reads from a thread pool keep the disk queue full, so the first epoch
+    does not pay the cold-start latency of lazy reads from the DataLoader workers.
+    Arguments:
+        paths: list of file paths; entries which are not existing files (e.g., NaN or '' for missing scans) are ignored.
+        workers: int, number of threads issuing reads.
+    """
+    paths = sorted(set(p for p in paths if isinstance(p, str) and os.path.isfile(p)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(populate, paths))